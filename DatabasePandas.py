@@ -6,18 +6,288 @@ import geocoder
 import random
 import Levenshtein
 import os
+import hashlib
 import time
 from dateutil.relativedelta import *
 from datetime import datetime, date
-from requests.exceptions import ReadTimeout
+from requests.exceptions import ReadTimeout, ConnectionError
 from difflib import SequenceMatcher as SM
 from pandas import DataFrame
 from time import mktime
 from numpy import sqrt
+from multiprocessing import Pool
+from Geolocation import BingBackend, GeocodingError
 
 
 class Matching:
     ALL, ALL_T_NAME, ALL_T_NAME_T_STREET, ALL_P_NAME, ALL_P_NAME_P_STREET, ALL_P_DYNAMIC = range(6)
+    # Names used as suffix of the fields when several algorithms are compared
+    NAMES = {ALL: 'all', ALL_T_NAME: 'all_t_name', ALL_T_NAME_T_STREET: 'all_t_name_t_street', ALL_P_NAME: 'all_p_name',
+             ALL_P_NAME_P_STREET: 'all_p_name_p_street', ALL_P_DYNAMIC: 'all_p_dynamic'}
+
+
+class Candidates:
+    POSTALCODE, TRIGRAM, POSTALCODE_TRIGRAM, GRID, POSTALCODE_GRID = range(5)
+
+
+class PostalCodeIndex():
+    """
+        Block index over the postal codes of the swisshotels. The codes are sorted once, afterwards all swisshotels
+        close to a postal code are found by bisecting the sorted array instead of scanning the whole table for every
+        hotel which has to be matched.
+    """
+
+    def __init__(self, codes):
+        """
+        :param codes: Series with the postal code of each swisshotel (in the order of the swisshotel rows), entries
+                      without a code will never be returned as candidates
+        """
+        codes = np.asarray(codes, dtype=float)
+        valid = np.flatnonzero(~np.isnan(codes))
+        # A stable sort keeps the original row order among equal codes
+        order = valid[np.argsort(codes[valid], kind='mergesort')]
+        self.positions = order
+        self.codes = codes[order]
+
+    def candidates(self, code, distance):
+        """
+        Find all the rows whose code is strictly less than 'distance' away from the given code
+        :param code: postal code of the hotel for which we need candidates
+        :param distance: maximal (exclusive) difference between the two codes
+        :return: array of row positions in the swisshotel table, in the original row order
+        """
+        lower = np.searchsorted(self.codes, code - distance, side='right')
+        upper = np.searchsorted(self.codes, code + distance, side='left')
+        return np.sort(self.positions[lower:upper])
+
+
+class TrigramIndex():
+    """
+        Inverted index over the character trigrams of the swisshotel fuzzy strings, stored as a sparse TF-IDF matrix.
+        The nearest swisshotels of a whole block of fuzzy strings are found with a single sparse matrix product, which
+        does not rely on the postal code being available or correct.
+    """
+
+    def __init__(self, strings):
+        """
+        :param strings: Series with the fuzzy string of each swisshotel (in the order of the swisshotel rows), entries
+                        without a string will never be returned as candidates
+        """
+        # Only needed for this index, hence imported here
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        valid = strings.notnull().values
+        self.positions = np.flatnonzero(valid)
+        self.vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 3), lowercase=False)
+        # The rows are normalized, so the product of two rows is their cosine similarity
+        self.matrix = self.vectorizer.fit_transform(strings[valid]).T.tocsr()
+
+    def candidates(self, strings, k):
+        """
+        Find the k most similar swisshotels for each string
+        :param strings: Series of fuzzy strings
+        :param k: maximal number of candidates per string
+        :return: list with one array of row positions in the swisshotel table per string, in the original row order
+        """
+        similarities = (self.vectorizer.transform(strings.fillna('')) * self.matrix).tocsr()
+        nearest = []
+        for i in range(similarities.shape[0]):
+            start, end = similarities.indptr[i], similarities.indptr[i + 1]
+            columns = similarities.indices[start:end]
+            if len(columns) > k:
+                columns = columns[np.argpartition(-similarities.data[start:end], k - 1)[:k]]
+            nearest.append(np.sort(self.positions[columns]))
+        return nearest
+
+
+class GridIndex():
+    """
+        Spatial index over the coordinates of the swisshotels. Every swisshotel is put into a square cell of a regular
+        grid, the candidates close to a point are the swisshotels in its cell and in the eight neighbouring cells, so
+        every swisshotel less than one cell size away is found.
+    """
+
+    def __init__(self, xs, ys, cell_size):
+        """
+        :param xs: Series with the first coordinate of each swisshotel (in the order of the swisshotel rows)
+        :param ys: Series with the second coordinate of each swisshotel, entries without both coordinates will never
+                   be returned as candidates
+        :param cell_size: side length of a cell, in the unit of the coordinates
+        """
+        self.cell_size = cell_size
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        valid = np.flatnonzero(~np.isnan(xs) & ~np.isnan(ys))
+        self.cell_positions = {}
+        for pos, cell in zip(valid, self.cells(xs[valid], ys[valid])):
+            self.cell_positions.setdefault(cell, []).append(pos)
+
+    def cells(self, xs, ys):
+        """
+        :param xs: numpy array of first coordinates, must not contain NaN
+        :param ys: numpy array of second coordinates, must not contain NaN
+        :return: list with the cell (a tuple of two integers) of each point
+        """
+        return list(zip(np.floor(xs / self.cell_size).astype(int).tolist(),
+                        np.floor(ys / self.cell_size).astype(int).tolist()))
+
+    def candidates(self, cell):
+        """
+        Find all the rows in the given cell and its neighbours
+        :param cell: cell of the hotel for which we need candidates, as returned by cells
+        :return: array of row positions in the swisshotel table, in the original row order
+        """
+        x, y = cell
+        positions = []
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                positions += self.cell_positions.get((x + dx, y + dy), [])
+        return np.sort(np.array(positions, dtype=int))
+
+
+class NearestNeighbourIndex():
+    """
+        KD-tree over a set of points (latitude x, longitude y in degrees) which answers the nearest neighbour queries
+        of a whole batch of points in one call. With the haversine option the points are mapped to the unit sphere, the
+        nearest point by straight line distance through the sphere is then also the nearest by great-circle distance.
+    """
+
+    def __init__(self, xs, ys, haversine=False):
+        """
+        :param xs: Series with the first coordinate (latitude) of each point
+        :param ys: Series with the second coordinate (longitude) of each point, points without both coordinates
+                   will never be returned
+        :param haversine: Use the great-circle distance instead of the euclidean distance of the coordinates
+        """
+        # Only needed for this index, hence imported here
+        from scipy.spatial import cKDTree
+        self.haversine = haversine
+        points = self.to_points(xs, ys)
+        valid = ~np.isnan(points).any(axis=1)
+        self.positions = np.flatnonzero(valid)
+        self.tree = cKDTree(points[valid])
+
+    def to_points(self, xs, ys):
+        """
+        :param xs: Series or array with the first coordinates, strings are converted and invalid entries become NaN
+        :param ys: Series or array with the second coordinates
+        :return: numpy array with one row per point, in the space in which the distances are computed
+        """
+        xs = pd.to_numeric(pd.Series(np.asarray(xs)), errors='coerce').values.astype(float)
+        ys = pd.to_numeric(pd.Series(np.asarray(ys)), errors='coerce').values.astype(float)
+        if not self.haversine:
+            return np.column_stack([xs, ys])
+        latitudes, longitudes = np.radians(xs), np.radians(ys)
+        return np.column_stack([np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes),
+                                np.sin(latitudes)])
+
+    def nearest(self, xs, ys):
+        """
+        Find the nearest point for every query point
+        :param xs: Series or array with the first coordinate of the query points
+        :param ys: Series or array with the second coordinate of the query points
+        :return: array with the row position of the nearest point, -1 for query points without coordinates
+        """
+        points = self.to_points(xs, ys)
+        valid = ~np.isnan(points).any(axis=1)
+        nearest = np.full(len(points), -1, dtype=int)
+        if valid.any():
+            _, found = self.tree.query(points[valid])
+            nearest[valid] = self.positions[found]
+        return nearest
+
+
+class EconomicRegionIndex():
+    """
+        Index over the economic regions which finds the region of hotels by postal code, by city name or as the region
+        closest to their coordinates. It is built once from the economic data and never changed afterwards, so it can
+        be shared by all matching steps and pickled to the disk.
+    """
+
+    def __init__(self, economic_data, coordinates, haversine=False):
+        """
+        :param economic_data: DataFrame with the fields 'edid', 'ed_city' and 'ed_city_codes' (comma separated codes)
+        :param coordinates: DataFrame with the fields 'edid', 'x' and 'y' of the regions
+        :param haversine: Use the great-circle distance to find the closest region
+        """
+        self.haversine = haversine
+        self.source_hash = self.create_source_hash(economic_data, coordinates)
+        self.code_to_id = {}
+        self.city_to_id = {}
+        for edid, codes in zip(economic_data['edid'].values, economic_data['ed_city_codes'].values):
+            if pd.notnull(codes):
+                for code in str(codes).split(','):
+                    self.code_to_id[self.code_key(code)] = edid
+        for edid, city in zip(economic_data['edid'].values, economic_data['ed_city'].values):
+            if pd.notnull(city):
+                self.city_to_id[self.city_key(city)] = edid
+        self.ids = np.append(coordinates['edid'].values.astype(object), np.NaN)
+        self.nearest_index = NearestNeighbourIndex(coordinates['x'], coordinates['y'], haversine)
+
+    @staticmethod
+    def create_source_hash(economic_data, coordinates):
+        """
+        :param economic_data: DataFrame with the fields 'edid', 'ed_city' and 'ed_city_codes'
+        :param coordinates: DataFrame with the fields 'edid', 'x' and 'y' of the regions
+        :return: hash of all the data the index is built from, to know if a stored index is still valid
+        """
+        hashes = [pd.util.hash_pandas_object(economic_data[['edid', 'ed_city', 'ed_city_codes']], index=False),
+                  pd.util.hash_pandas_object(coordinates[['edid', 'x', 'y']], index=False)]
+        return hashlib.md5(b''.join(h.values.tobytes() for h in hashes)).hexdigest()
+
+    def code_key(self, code):
+        """
+        :param code: postal code as number or string
+        :return: the code as string without decimals, NaN if it is missing
+        """
+        if pd.isnull(code):
+            return np.NaN
+        try:
+            return str(int(float(code)))
+        except ValueError:
+            return str(code).strip()
+
+    def city_key(self, city):
+        """
+        :param city: name of a city
+        :return: the lower case name, NaN if it is missing
+        """
+        if pd.isnull(city):
+            return np.NaN
+        return city.strip().lower()
+
+    def lookup(self, codes, cities, xs, ys, priority=('code', 'city', 'nearest')):
+        """
+        Find the economic region of every hotel, each method is only applied to the hotels which were not matched by
+        the methods before it
+        :param codes: Series with the postal codes of the hotels
+        :param cities: Series with the city names of the hotels
+        :param xs: Series with the first coordinate of the hotels
+        :param ys: Series with the second coordinate of the hotels
+        :param priority: order in which the methods 'code', 'city' and 'nearest' are tried
+        :return: DataFrame with the index of codes, the 'edid' of every hotel and 'ed_match', the method which found it
+        """
+        edids = np.full(len(codes), np.NaN, dtype=object)
+        matches = np.full(len(codes), np.NaN, dtype=object)
+        for method in priority:
+            unmatched = np.flatnonzero(pd.isnull(edids))
+            if method == 'code':
+                found = codes.iloc[unmatched].map(lambda code: self.code_to_id.get(self.code_key(code), np.NaN)).values
+            elif method == 'city':
+                found = cities.iloc[unmatched].map(lambda city: self.city_to_id.get(self.city_key(city), np.NaN)).values
+            elif method == 'nearest':
+                found = self.ids[self.nearest_index.nearest(xs.iloc[unmatched], ys.iloc[unmatched])]
+            else:
+                raise ValueError('Unrecognized economic region lookup method')
+            unmatched = unmatched[pd.notnull(found)]
+            edids[unmatched] = found[pd.notnull(found)]
+            matches[unmatched] = method
+        result = DataFrame({'edid': edids, 'ed_match': matches}, index=codes.index, columns=['edid', 'ed_match'])
+        try:
+            # Numeric ids get a numeric column like before
+            result['edid'] = pd.to_numeric(result['edid'])
+        except (ValueError, TypeError):
+            pass
+        return result
 
 
 class Database():
@@ -35,41 +305,100 @@ class Database():
     SWISSHOTEL_LINK = 'swisshotel'
     SWISSHOTEL_NAME = 'sh_name'
     geolocation_cache = {}
+    # Persistent GeocodeCache behind geolocation_cache, disabled if None
+    geocode_cache = None
+    # GeocodingEngine which resolves whole columns of addresses concurrently, if None they are resolved one by one
+    geocoding_engine = None
+    # PostalCodeGazetteer which locates addresses without street offline, disabled if None
+    gazetteer = None
     # The pandas databases will be stored here
     hotels = None
     swisshotels = None
     reviews = None
     yearly_ratings = None
     matching = None
+    # Matching of every algorithm side by side, see create_matching_all_algorithms
+    matching_algorithms = None
+    # Score cutoff with the best accuracy, found by validate_matching
+    matching_cutoff = None
     hotel_economic_matching = None
     subset_file = None
     merged = None
     tripadvisor_hotels = None
     economic_data = None
+    # Index over the economic regions shared by all the economic matching steps
+    economic_region_index = None
+    # Index over the swisshotel postal codes, rebuilt at the start of every matching run
+    postalcode_index = None
+    POSTALCODE_DISTANCE = 50
+    # Index over the character trigrams of the swisshotel fuzzy strings and the number of candidates it returns
+    trigram_index = None
+    TRIGRAM_CANDIDATES = 20
+    # Index over the swisshotel coordinates and the size of its cells in degrees (about 1.1km north-south)
+    grid_index = None
+    GRID_CELL_SIZE = 0.01
+    # On-disk cache of the normalized fuzzy fields, disabled if no file is given
+    fuzzy_cache_file = None
+    fuzzy_cache = None
+    # Fuzzy components which can be scored: (field in hotels/tripadvisor, field in swisshotels)
+    FUZZY_COMPONENTS = {'all': ('fuzzy', 'sh_fuzzy'), 'name': ('fuzzy_name', 'sh_fuzzy_name'),
+                        'street': ('fuzzy_street', 'sh_fuzzy_street'), 'city': ('fuzzy_city', 'sh_fuzzy_city')}
+    # Components needed by each matching algorithm
+    MATCHING_COMPONENTS = {Matching.ALL: ['all'],
+                           Matching.ALL_T_NAME: ['all', 'name'],
+                           Matching.ALL_T_NAME_T_STREET: ['all', 'name', 'street'],
+                           Matching.ALL_P_NAME: ['all', 'name'],
+                           Matching.ALL_P_NAME_P_STREET: ['all', 'name', 'street'],
+                           Matching.ALL_P_DYNAMIC: ['all', 'name', 'street', 'city']}
+    # Number of hotel/swisshotel pairs seen by the matching and how many of them were rejected by the cheap
+    # upper bounds before the full comparison
+    fuzzy_comparisons = 0
+    fuzzy_comparisons_skipped = 0
 
 
     def store_scraping_results(self, results, hotels_database, tripadvisor_hotels = False):
         """
         The results of the scraping will be stored in a dictionary and need to be filled into the database
         If the attribute does not yet exist, it will be filled with NaN for other entries.
+        The results are converted to one DataFrame, aligned to the rows of the database by id and written column by
+        column, new attributes are added to the database all at once.
         :param results: A dictionary which contains a dictionary, the keys are the ids from the database hotels
         :param hotels_database: If the attribute and its key belong to the hotels or swisshotels database
+        :param tripadvisor_hotels: If the keys are the links of the tripadvisor hotels database
         :return: None
         """
         if tripadvisor_hotels:
-            for key in results.keys():
-                attributes = results[key]
-                # TODO not very elegant, might be easier to create a Series object and store all at once
-                for attribute_name in attributes:
-                    self.tripadvisor_hotels.loc[self.tripadvisor_hotels['link-href'] == key, attribute_name] = attributes[attribute_name]
+            database, id_field = self.tripadvisor_hotels, 'link-href'
+        elif hotels_database:
+            database, id_field = self.hotels, self.ID
         else:
-            for key in results.keys():
-                attributes = results[key]
-                for attribute_name in attributes:
-                    if hotels_database:
-                        self.hotels.loc[self.hotels[self.ID] == key, attribute_name] = attributes[attribute_name]
-                    else:
-                        self.swisshotels.loc[self.swisshotels[self.SWISS_ID] == key, attribute_name] = attributes[attribute_name]
+            database, id_field = self.swisshotels, self.SWISS_ID
+        if len(results) == 0:
+            return
+        values = DataFrame.from_dict(results, orient='index')
+        # Only the attributes which were scraped for a hotel are written, even if their value is missing
+        present = DataFrame.from_dict(dict((key, dict((attribute_name, True) for attribute_name in attributes))
+                                           for key, attributes in results.items()), orient='index')
+        aligned = values.reindex(database[id_field].values)
+        written = present.reindex(index=database[id_field].values, columns=values.columns).notnull()
+        new_columns = {}
+        for attribute_name in values.columns:
+            mask = written[attribute_name].values
+            column = pd.Series(aligned[attribute_name].values, index=database.index)
+            if attribute_name in database.columns:
+                database[attribute_name] = database[attribute_name].where(~mask, column)
+            else:
+                new_columns[attribute_name] = column.where(mask, np.NaN)
+        if len(new_columns) > 0:
+            database = pd.concat([database, DataFrame(new_columns, index=database.index,
+                                                      columns=[name for name in values.columns
+                                                               if name in new_columns])], axis=1)
+        if tripadvisor_hotels:
+            self.tripadvisor_hotels = database
+        elif hotels_database:
+            self.hotels = database
+        else:
+            self.swisshotels = database
 
 
     def clean_url(self, url):
@@ -499,6 +828,12 @@ class Database():
         merged.loc[merged['stars'].isnull(), 'stars'] = merged['ta_stars']
         after = str(merged['stars'].notnull().sum())
         print("After swisshotel we had stars for  " + before + " rooms, now we have " + after)
+        # Hotels which could not be geocoded get the centroid of their postal code, before the address fields are
+        # dropped for the prediction
+        if self.gazetteer is not None:
+            merged['x'], merged['y'] = self.fill_coordinates_from_gazetteer(
+                merged['x'], merged['y'], self.combine_available_fields(merged, ['go_postalcode', 'ta_postalcode', 'plz']),
+                self.combine_available_fields(merged, ['go_city', 'ta_city', 'city']))
         self.merged = merged.drop(to_remove, axis=1)
 
     def store_merged_data(self, filename):
@@ -629,18 +964,113 @@ class Database():
     """
         Address to latitude and longitude, caching for multiple requests
     """
-    def get_coordinates(self, address):
+    def canonicalize_address(self, address):
+        """
+        Key under which an address is geocoded and cached. The address is normalized with the rules used for the hotel
+        names and the whitespace is collapsed, so addresses which only differ in case, accents, punctuation or empty
+        parts share the same key.
+        :param address: address as string
+        :return: the canonical key of the address
+        """
+        return ' '.join(self.normalize_hotel_name(address).split())
+
+    def get_coordinates(self, address, key=None):
+        """
+        Geocode an address. The results are memoized for this process and, if geocode_cache is set, stored on the
+        disk. Addresses which failed recently are not queried again until their backoff has passed.
+        :param address: address to geocode
+        :param key: key of the address in the caches, by default its canonical key
+        :return: [lat, lng], None if the address was not found or ['',''] if the query timed out or failed
+        """
         address = str(address)
-        if self.geolocation_cache.has_key(address):
-            return self.geolocation_cache[address]
+        if key is None:
+            key = self.canonicalize_address(address)
+        if key in self.geolocation_cache:
+            return self.geolocation_cache[key]
+        if self.geocode_cache is not None:
+            geolocation = self.geocode_cache.get(key)
+            if geolocation is not None:
+                self.geolocation_cache[key] = geolocation
+                return geolocation
+            error = self.geocode_cache.get_failure(key)
+            if error == 'not found':
+                return None
+            if error is not None:
+                return ['','']
         print("Collecting geolocation for: " + address)
         try:
-            geolocation = geocoder.bing(address, key="Not public").latlng
-            self.geolocation_cache[address] = geolocation
-            return geolocation
-        except ReadTimeout:
-            print('Read Timeout for ' + address)
+            geolocation = BingBackend().geocode(address)
+        except (ReadTimeout, ConnectionError, GeocodingError) as error:
+            print('Geocoding failed for ' + address + ': ' + str(error))
+            if self.geocode_cache is not None:
+                self.geocode_cache.put_failure(key, 'timeout')
             return ['','']
+        self.geolocation_cache[key] = geolocation
+        if self.geocode_cache is not None:
+            if geolocation is None:
+                self.geocode_cache.put_failure(key, 'not found')
+            else:
+                self.geocode_cache.put(key, geolocation)
+        return geolocation
+
+    def geocode_addresses(self, addresses, codes=None, cities=None, coarse=None):
+        """
+        Geocode a column of addresses. If the gazetteer is set and the postal codes or cities are given, the coarse
+        addresses are located at the centroid of their postal code or city without any query, only the addresses which
+        need the precision of the street or are not in the gazetteer are sent to the geocoder.
+        :param addresses: Series of addresses
+        :param codes: Series of postal codes with the index of addresses, None if unknown
+        :param cities: Series of city names with the index of addresses, None if unknown
+        :param coarse: boolean Series with the index of addresses, True where the address has no street. By default all
+        addresses are coarse
+        :return: Series with [lat, lng], None or ['',''] for every address, with the index of addresses
+        """
+        geolocations = np.full(len(addresses), None, dtype=object)
+        if self.gazetteer is not None and (codes is not None or cities is not None):
+            if codes is None:
+                codes = pd.Series(np.NaN, index=addresses.index)
+            if cities is None:
+                cities = pd.Series(np.NaN, index=addresses.index)
+            if coarse is None:
+                coarse = pd.Series(True, index=addresses.index)
+            for position in np.flatnonzero(coarse.values.astype(bool)):
+                geolocations[position] = self.gazetteer.locate(codes.iloc[position], cities.iloc[position])
+            print("Located " + str(sum(geolocation is not None for geolocation in geolocations)) + " of " +
+                  str(len(addresses)) + " addresses with the postal code gazetteer")
+        remaining = np.flatnonzero([geolocation is None for geolocation in geolocations])
+        if len(remaining) > 0:
+            queried = self.geocode_addresses_online(addresses.iloc[remaining])
+            for position, geolocation in zip(remaining, queried.values):
+                geolocations[position] = geolocation
+        return pd.Series(geolocations, index=addresses.index)
+
+    def geocode_addresses_online(self, addresses):
+        """
+        Geocode a column of addresses. Only the first address of every canonical key is geocoded, with the geocoding
+        engine if it is set, otherwise with get_coordinates, and its result is used for all the addresses with the
+        same key. Successful results are memoized in geolocation_cache as well.
+        :param addresses: Series of addresses
+        :return: Series with the result of get_coordinates for every address, with the index of addresses
+        """
+        addresses = addresses.apply(lambda address: str(address))
+        keys = addresses.apply(lambda address: self.canonicalize_address(address))
+        # One address is sent to the geocoder for every key
+        queries = dict(zip(keys.values[::-1], addresses.values[::-1]))
+        print("Geocoding " + str(len(addresses)) + " addresses with " + str(len(queries)) + " distinct keys")
+        if self.geocoding_engine is None:
+            results = dict((key, self.get_coordinates(address, key)) for key, address in queries.items())
+            if self.geocode_cache is not None:
+                self.geocode_cache.commit()
+            return keys.map(lambda key: results[key])
+        results = dict((key, self.geolocation_cache[key]) for key in queries if key in self.geolocation_cache)
+        queried = self.geocoding_engine.geocode(dict((key, address) for key, address in queries.items()
+                                                     if key not in results))
+        for key, geolocation in queried.items():
+            results[key] = geolocation
+            # Timeouts are not memoized, like in get_coordinates
+            if geolocation != ['', '']:
+                self.geolocation_cache[key] = geolocation
+        return keys.map(lambda key: results[key])
 
     def collect_economic_geolocation_data(self, output_file):
         """
@@ -651,7 +1081,8 @@ class Database():
         """
         economic_data = self.economic_data
         economic_data['address'] = economic_data['ed_city'].apply(lambda city: city + ", Switzerland")
-        economic_data['coord'] = economic_data['address'].apply(lambda elem: self.get_coordinates(elem))
+        # The regions are municipalities, their coordinates are the centroids of the localities
+        economic_data['coord'] = self.geocode_addresses(economic_data['address'], cities=economic_data['ed_city'])
         # Split them up in a x and y part
         economic_data['x'] = economic_data.coord.apply(lambda x: x[0])
         economic_data['y'] = economic_data.coord.apply(lambda x: x[1])
@@ -671,7 +1102,8 @@ class Database():
         tripadvisor.loc[:, 'ta_city'] = tripadvisor['ta_city'].apply(
             lambda x: x if pd.notnull(x) else '')
         tripadvisor['address'] = tripadvisor['ta_streetaddress'] + ", " + tripadvisor['ta_postalcode'] + " " + tripadvisor['ta_city'] + ", Switzerland"
-        tripadvisor['coord'] = tripadvisor['address'].apply(lambda elem: self.get_coordinates(elem))
+        tripadvisor['coord'] = self.geocode_addresses(tripadvisor['address'], tripadvisor['ta_postalcode'],
+                                                      tripadvisor['ta_city'], tripadvisor['ta_streetaddress'] == '')
         # Split them up in a x and y part
         #tripadvisor['x'] = tripadvisor.coord.apply(lambda x: x[0])
         #tripadvisor['y'] = tripadvisor.coord.apply(lambda x: x[1])
@@ -698,8 +1130,12 @@ class Database():
         # Update the address with the given data (not very precise sometimes)
         self.hotels.loc[self.hotels['address'].isnull(), 'address'] = self.hotels.street + ", " + self.hotels.plz \
                                                                       + " " + self.hotels.city + ", Switzerland"
+        # Without any street the postal code or city with the same priority is enough
+        codes = self.hotels['go_postalcode'].fillna(self.hotels['ta_postalcode']).fillna(self.hotels['plz'])
+        cities = self.hotels['go_city'].fillna(self.hotels['ta_city']).fillna(self.hotels['city'])
         # Retrieve coordinates from bing
-        self.hotels['coord'] = self.hotels['address'].apply(lambda elem: self.get_coordinates(elem))
+        self.hotels['coord'] = self.geocode_addresses(self.hotels['address'], codes, cities,
+                                                      self.hotels['address'].isnull())
         # Split them up in a x and y part
         self.hotels['x'] = self.hotels.coord.apply(lambda x: x[0])
         self.hotels['y'] = self.hotels.coord.apply(lambda x: x[1])
@@ -1085,17 +1521,22 @@ class Database():
         tripadvisor = pd.read_csv(input_file, encoding='utf-8-sig')
         return tripadvisor['link-href'].values.tolist()
 
-    def get_all_tripadvisor_urls(self, input_file, test_mode, test_limit, test_randomize):
+    def get_all_tripadvisor_urls(self, input_file, test_mode, test_limit, test_randomize, completed=None):
         """
         Reads a file with URLs and returns the links according to the test parameters
         :param test_mode:
         :param test_limit:
         :param test_randomize:
+        :param completed: set of URLs which were already scraped by a previous run and are left out
         :return:
         """
         if self.tripadvisor_hotels is None:
             self.tripadvisor_hotels = pd.read_csv(input_file, encoding='utf-8-sig')
         tripadvisor_urls = self.tripadvisor_hotels['link-href'].values
+        if completed:
+            tripadvisor_urls = [url for url in tripadvisor_urls if url not in completed]
+            print("Skipping " + str(len(self.tripadvisor_hotels) - len(tripadvisor_urls)) + " tripadvisor urls scraped "
+                  "by a previous run")
         print("Have " + str(len(tripadvisor_urls)) + " tripadvisor urls to handle")
         return self.test_cropper(tripadvisor_urls, test_mode, test_limit, test_randomize)
 
@@ -1256,6 +1697,87 @@ class Database():
         return str
 
 
+    def create_fuzzy_fields(self, names, cities, streets, codes):
+        """
+        Normalize the name, city, street and postal code of hotels into the fields used for fuzzy matching. All
+        arguments need to share the same index.
+        :param names: Series of hotel names
+        :param cities: Series of city names
+        :param streets: Series of street addresses
+        :param codes: Series of postal codes as strings, empty string if not available
+        :return: DataFrame with the fields 'fuzzy', 'fuzzy_name', 'fuzzy_street' and 'fuzzy_city'
+        """
+        fields = DataFrame(index=names.index)
+        # Create and prepare the fuzzy field. We have to take care of NaN values as they might erase the whole line
+        # if not taken into account
+        fields['fuzzy'] = names + " " + cities.apply(lambda x: x if pd.notnull(x) else "") + " " + \
+                          streets.apply(lambda x: x if pd.notnull(x) else "") + " " + codes
+        # Normalize the fuzzy text
+        fields['fuzzy'] = fields['fuzzy'].apply(lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
+        fields['fuzzy'] = fields['fuzzy'].apply(lambda x: self.unique_list(x) if pd.notnull(x) else x)
+        # Add fuzzy name
+        fields['fuzzy_name'] = names.apply(
+            lambda x: self.normalize_hotel_name(x).replace('hotel', '').replace('restaurant', '') if pd.notnull(x) else x)
+        fields['fuzzy_name'] = fields['fuzzy_name'].apply(lambda x: self.unique_list(x) if pd.notnull(x) else x)
+        # Add fuzzy address
+        fields['fuzzy_street'] = streets.apply(lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
+        fields['fuzzy_street'] = fields['fuzzy_street'].apply(lambda x: self.unique_list(x) if pd.notnull(x) else x)
+        # Add fuzzy city
+        fields['fuzzy_city'] = cities.apply(lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
+        return fields
+
+    def create_parent_directory(self, filename):
+        """
+        Make sure the directory of a file exists before writing to it
+        :param filename: path to the file
+        :return: None
+        """
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def load_fuzzy_cache(self):
+        """
+        Read the cache of fuzzy fields from the disk, start with an empty one if the file does not exist yet
+        :return: None
+        """
+        if os.path.exists(self.fuzzy_cache_file):
+            self.fuzzy_cache = pd.read_pickle(self.fuzzy_cache_file)
+        else:
+            self.fuzzy_cache = DataFrame(columns=['fuzzy', 'fuzzy_name', 'fuzzy_street', 'fuzzy_city'])
+
+    def load_fuzzy_fields(self, names, cities, streets, codes):
+        """
+        Same as create_fuzzy_fields, but the results are taken from the on-disk cache if fuzzy_cache_file is set.
+        The cache is keyed by a hash of the source fields of each row, only rows whose name, city, street or code
+        are not in the cache yet are normalized, and the new rows are added to the cache file.
+        :param names: Series of hotel names
+        :param cities: Series of city names
+        :param streets: Series of street addresses
+        :param codes: Series of postal codes as strings, empty string if not available
+        :return: DataFrame with the fields 'fuzzy', 'fuzzy_name', 'fuzzy_street' and 'fuzzy_city'
+        """
+        if self.fuzzy_cache_file is None:
+            return self.create_fuzzy_fields(names, cities, streets, codes)
+        if self.fuzzy_cache is None:
+            self.load_fuzzy_cache()
+        sources = DataFrame({'name': names, 'city': cities, 'street': streets, 'code': codes},
+                            columns=['name', 'city', 'street', 'code'])
+        keys = pd.util.hash_pandas_object(sources, index=False).apply(lambda key: '%016x' % key)
+        missing = ~keys.isin(self.fuzzy_cache.index)
+        if missing.any():
+            fields = self.create_fuzzy_fields(names[missing], cities[missing], streets[missing], codes[missing])
+            fields.index = keys[missing].values
+            fields = fields[~fields.index.duplicated()]
+            self.fuzzy_cache = pd.concat([self.fuzzy_cache, fields])
+            self.create_parent_directory(self.fuzzy_cache_file)
+            self.fuzzy_cache.to_pickle(self.fuzzy_cache_file)
+        print("Fuzzy fields: " + str(len(keys) - missing.sum()) + " taken from the cache, " + str(missing.sum()) +
+              " newly created")
+        fields = self.fuzzy_cache.loc[keys.values]
+        fields.index = names.index
+        return fields
+
     def create_fuzzy_strings(self, verbose=False, swisshotels=True, hotels=True, tripadvisor=False):
         if self.swisshotels is None and swisshotels:
             raise ValueError('Read the Swisshotel data first')
@@ -1263,68 +1785,23 @@ class Database():
             raise ValueError('Read the Tripadvisor data first')
         # Create the fuzzy string for swisshotels if necessary
         if 'sh_fuzzy' not in self.swisshotels.keys() and swisshotels:
-            # Create and prepare a fuzzy field for swisshotels. We have to take care of NaN values as they might erase
-            # the whole line if not taken into account
-            self.swisshotels['sh_fuzzy'] = self.swisshotels['sh_name'] + " " + \
-                                           self.swisshotels['sh_city'].apply(
-                                               lambda x: x if pd.notnull(x) else "") + " " + \
-                                           self.swisshotels['sh_street'].apply(
-                                               lambda x: x if pd.notnull(x) else "") + " " + \
-                                           self.swisshotels['sh_code'].apply(lambda x: str(x) if pd.notnull(x) else "")
-            # Normalize the fuzzy text
-            self.swisshotels['sh_fuzzy'] = self.swisshotels['sh_fuzzy'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
-            self.swisshotels['sh_fuzzy'] = self.swisshotels['sh_fuzzy'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy name
-            self.swisshotels['sh_fuzzy_name'] = self.swisshotels['sh_name'].apply(
-                lambda x: self.normalize_hotel_name(x).replace('hotel', '').replace('restaurant', '') if pd.notnull(x) else x)
-            self.swisshotels['sh_fuzzy_name'] = self.swisshotels['sh_fuzzy_name'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy address
-            self.swisshotels['sh_fuzzy_street'] = self.swisshotels['sh_street'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
-            self.swisshotels['sh_fuzzy_street'] = self.swisshotels['sh_fuzzy_street'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy city
-            self.swisshotels['sh_fuzzy_city'] = self.swisshotels['sh_city'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
+            fields = self.load_fuzzy_fields(self.swisshotels['sh_name'], self.swisshotels['sh_city'],
+                                            self.swisshotels['sh_street'],
+                                            self.swisshotels['sh_code'].apply(lambda x: str(x) if pd.notnull(x) else ""))
+            for field in fields.keys():
+                self.swisshotels['sh_' + field] = fields[field]
 
         # Create all the fuzzy strings for tripadvisor hotels
         if 'fuzzy' not in self.tripadvisor_hotels.keys() and tripadvisor:
             # Easier to write with a temporary reference
             tripadvisor = self.tripadvisor_hotels
-            # Create and prepare a fuzzy field for swisshotels. We have to take care of NaN values as they might erase
-            # the whole line if not taken into account
-            tripadvisor['fuzzy'] = tripadvisor['ta_name'] + " " + \
-                                           tripadvisor['ta_city'].apply(
-                                               lambda x: x if pd.notnull(x) else "") + " " + \
-                                           tripadvisor['ta_streetaddress'].apply(
-                                               lambda x: x if pd.notnull(x) else "") + " " + \
-                                           tripadvisor['ta_postalcode'].apply(lambda x: str(int(x)) if pd.notnull(x) else "")
-
-            # Normalize the fuzzy text
-            tripadvisor['fuzzy'] = tripadvisor['fuzzy'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
-            tripadvisor['fuzzy'] = tripadvisor['fuzzy'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy name
-            tripadvisor['fuzzy_name'] = tripadvisor['ta_name'].apply(
-                lambda x: self.normalize_hotel_name(x).replace('hotel', '').replace('restaurant', '') if pd.notnull(
-                    x) else x)
-            tripadvisor['fuzzy_name'] = tripadvisor['fuzzy_name'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy address
-            tripadvisor['fuzzy_street'] = tripadvisor['ta_streetaddress'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
-            tripadvisor['fuzzy_street'] = tripadvisor['fuzzy_street'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy city
-            tripadvisor['fuzzy_city'] = tripadvisor['ta_city'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
+            fields = self.load_fuzzy_fields(tripadvisor['ta_name'], tripadvisor['ta_city'],
+                                            tripadvisor['ta_streetaddress'],
+                                            tripadvisor['ta_postalcode'].apply(lambda x: str(int(x)) if pd.notnull(x) else ""))
+            for field in fields.keys():
+                tripadvisor[field] = fields[field]
             self.tripadvisor_hotels = tripadvisor
 
-
         # Create the fuzzy strings for the hotels if necessary
         if 'fuzzy' not in self.hotels.keys() and hotels:
             # Get wherever possible the data from booking or tripadvisor, then from google for address and name
@@ -1339,25 +1816,11 @@ class Database():
                 print("#street " + str(all_streets['all_street'].count()))
                 print("#postalcode " + str(all_postalcode['all_postalcode'].count()))
 
-            all_names['fuzzy'] = all_names['all_name'] + " " + all_cities['all_city'].apply(
-                lambda x: x if pd.notnull(x) else "") + " " + all_streets['all_street'].apply(
-                lambda x: x if pd.notnull(x) else "") + " " + \
-                                 all_postalcode['all_postalcode'].apply(lambda x: str(int(x)) if pd.notnull(x) else "")
-            # Prepare the fuzzy field for matching by removing special characters and removing duplicates
-            all_names['fuzzy'] = all_names['fuzzy'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
-            all_names['fuzzy'] = all_names['fuzzy'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add the fuzzy name
-            all_names['fuzzy_name'] = all_names['all_name'].apply(
-                lambda x: self.normalize_hotel_name(x).replace('hotel', '').replace('restaurant', '') if pd.notnull(x) else x)
-            all_names['fuzzy_name'] = all_names['fuzzy_name'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
-            # Add fuzzy_street
-            all_names['fuzzy_street'] = all_streets['all_street'].apply(
-                lambda x: self.normalize_hotel_name(x) if pd.notnull(x) else x)
-            all_names['fuzzy_street'] = all_names['fuzzy_street'].apply(
-                lambda x: self.unique_list(x) if pd.notnull(x) else x)
+            fields = self.load_fuzzy_fields(all_names['all_name'], all_cities['all_city'], all_streets['all_street'],
+                                            all_postalcode['all_postalcode'].apply(lambda x: str(int(x)) if pd.notnull(x) else ""))
+            # The hotels have no fuzzy city field
+            for field in ['fuzzy', 'fuzzy_name', 'fuzzy_street']:
+                all_names[field] = fields[field]
             # Add the postal code and street names
             all_names = all_names.merge(all_postalcode, on='tempid', how='left')
             all_names = all_names.merge(all_streets, on='tempid', how='left')
@@ -1373,87 +1836,554 @@ class Database():
     def test(self, a, b, c, d):
         return (a+b+c)/3
 
-    def find_best_fuzzy_match(self, row, algo, tripadvisor=False):
-        if tripadvisor:
-            id_name = 'taid'
-            postalcode_name = 'ta_postalcode'
-        else:
-            id_name = 'tempid'
-            postalcode_name = 'all_postalcode'
-        if pd.isnull(row['fuzzy']) or pd.isnull(row[postalcode_name]):
-            return pd.Series({id_name : row[id_name], 'swissid': np.NaN, 'score':np.NaN})
-        temp_swisshotels = self.swisshotels[abs(self.swisshotels['sh_code'] - int(row[postalcode_name])) < 50]
-        # Match according to the predefined matching algorithm, the final score should however be stored in the field
-        # 'fuzzy score'.
+    def create_postalcode_index(self):
+        """
+        Build the postal code index over the swisshotels, it is shared by all the rows and matching algorithms of
+        a run and has to be rebuilt whenever the swisshotel data changes
+        :return: None
+        """
+        self.postalcode_index = PostalCodeIndex(self.swisshotels['sh_code'])
+
+    def create_trigram_index(self):
+        """
+        Build the trigram index over the swisshotel fuzzy strings, has to be rebuilt whenever the swisshotel data
+        changes
+        :return: None
+        """
+        self.trigram_index = TrigramIndex(self.swisshotels['sh_fuzzy'])
+
+    def create_grid_index(self):
+        """
+        Build the grid index over the swisshotel coordinates, has to be rebuilt whenever the swisshotel data changes
+        :return: None
+        """
+        if 'sh_x' not in self.swisshotels.keys():
+            raise ValueError('Load the swisshotel coordinates first')
+        self.grid_index = GridIndex(self.swisshotels['sh_x'], self.swisshotels['sh_y'], self.GRID_CELL_SIZE)
+
+    def create_candidate_indexes(self, candidates):
+        """
+        Build the indexes over the swisshotels needed by a candidate generation at the start of a matching run
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :return: None
+        """
+        self.create_postalcode_index()
+        if candidates in [Candidates.TRIGRAM, Candidates.POSTALCODE_TRIGRAM]:
+            self.create_trigram_index()
+        if candidates in [Candidates.GRID, Candidates.POSTALCODE_GRID]:
+            self.create_grid_index()
+
+    def fuzzy_score_matrix(self, queries, candidates, levenshtein=False):
+        """
+        Compare every query string with every candidate string. Each distinct pair of strings is only compared once
+        and for SequenceMatcher the candidate is set as second sequence, so its analysis is reused for all queries.
+        Missing strings on either side get a score of 0.
+        :param queries: Series of fuzzy strings from the hotels
+        :param candidates: Series of fuzzy strings from the swisshotels
+        :param levenshtein: Use the Levenshtein ratio instead of the SequenceMatcher ratio
+        :return: numpy array of shape (len(queries), len(candidates))
+        """
+        query_codes, query_uniques = pd.factorize(queries)
+        candidate_codes, candidate_uniques = pd.factorize(candidates)
+        unique_scores = np.zeros((len(query_uniques) + 1, len(candidate_uniques) + 1))
+        matcher = SM(None)
+        for j, b in enumerate(candidate_uniques):
+            if levenshtein:
+                for i, a in enumerate(query_uniques):
+                    unique_scores[i, j] = Levenshtein.ratio(a, b)
+            else:
+                matcher.set_seq2(b)
+                for i, a in enumerate(query_uniques):
+                    matcher.set_seq1(a)
+                    unique_scores[i, j] = matcher.ratio()
+        # Missing values are factorized to -1, which points to the last row/column filled with zeros
+        return unique_scores[np.ix_(query_codes, candidate_codes)]
+
+    def create_fuzzy_score_matrices(self, hotels, swisshotels, components, levenshtein=False):
+        """
+        Fill the score matrices of the requested fuzzy components between a block of hotels and a block of
+        swisshotels in one call
+        :param hotels: DataFrame containing the fuzzy fields of the hotels
+        :param swisshotels: DataFrame containing the fuzzy fields of the candidate swisshotels
+        :param components: names of the components to score, keys of FUZZY_COMPONENTS
+        :param levenshtein: Use the Levenshtein ratio instead of the SequenceMatcher ratio
+        :return: dictionary from component name to a numpy array of shape (len(hotels), len(swisshotels))
+        """
+        matrices = {}
+        for component in components:
+            hotel_field, swisshotel_field = self.FUZZY_COMPONENTS[component]
+            # Not every dataset has every fuzzy field (hotels have no fuzzy city), treat them as missing
+            if hotel_field in hotels.keys():
+                queries = hotels[hotel_field]
+            else:
+                queries = pd.Series([np.NaN] * len(hotels), dtype=object)
+            matrices[component] = self.fuzzy_score_matrix(queries, swisshotels[swisshotel_field], levenshtein)
+        return matrices
+
+    def count_fuzzy_fields(self, hotels):
+        """
+        :param hotels: DataFrame with the fuzzy fields of the hotels
+        :return: numpy array with the number of fields each hotel can be scored on by Matching.ALL_P_DYNAMIC
+        """
+        counter = np.full(len(hotels), 2.0)
+        for component in ['street', 'city']:
+            hotel_field = self.FUZZY_COMPONENTS[component][0]
+            if hotel_field in hotels.keys():
+                counter += hotels[hotel_field].notnull().values
+        return counter
+
+    def combine_fuzzy_scores(self, matrices, algo, field_counts):
+        """
+        Combine the component scores into the final score of a matching algorithm. Every algorithm is non-decreasing
+        in each component, so combining upper bounds of the components gives an upper bound of the final score.
+        :param matrices: dictionary of component score matrices as returned by create_fuzzy_score_matrices
+        :param algo: Matching algorithm code
+        :param field_counts: number of available fields per hotel as returned by count_fuzzy_fields
+        :return: numpy array of shape (len(hotels), len(swisshotels)) with the final scores
+        """
         if algo == Matching.ALL:
-            temp_swisshotels.loc[:, 'fuzzy_score'] = temp_swisshotels['sh_fuzzy'].apply(lambda x: self.compare_two_strings(row['fuzzy'], x) if pd.notnull(x) else 0.0)
+            return matrices['all']
         elif algo == Matching.ALL_T_NAME:
-            temp_swisshotels.loc[:, 'fuzzy_score_all'] = temp_swisshotels['sh_fuzzy'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_name'] = temp_swisshotels['sh_fuzzy_name'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_name'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score'] = temp_swisshotels.apply(
-                lambda r: pow(r['fuzzy_score_all'] * r['fuzzy_score_name'], 0.5), axis=1)
+            return np.power(matrices['all'] * matrices['name'], 0.5)
         elif algo == Matching.ALL_T_NAME_T_STREET:
-            temp_swisshotels.loc[:, 'fuzzy_score_all'] = temp_swisshotels['sh_fuzzy'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_name'] = temp_swisshotels['sh_fuzzy_name'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_name'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_street'] = temp_swisshotels['sh_fuzzy_street'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_street'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score'] = temp_swisshotels.apply(
-                lambda r: pow(r['fuzzy_score_all'] * r['fuzzy_score_name'] * r['fuzzy_score_street'],1.0/3), axis=1)
+            return np.power(matrices['all'] * matrices['name'] * matrices['street'], 1.0/3)
         elif algo == Matching.ALL_P_NAME:
-            temp_swisshotels.loc[:, 'fuzzy_score_all'] = temp_swisshotels['sh_fuzzy'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_name'] = temp_swisshotels['sh_fuzzy_name'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_name'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score'] = temp_swisshotels.apply(
-                lambda r: (r['fuzzy_score_all'] + r['fuzzy_score_name'])/2, axis=1)
+            return (matrices['all'] + matrices['name']) / 2
         elif algo == Matching.ALL_P_NAME_P_STREET:
-            temp_swisshotels.loc[:, 'fuzzy_score_all'] = temp_swisshotels['sh_fuzzy'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_name'] = temp_swisshotels['sh_fuzzy_name'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_name'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_street'] = temp_swisshotels['sh_fuzzy_street'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_street'], x) if pd.notnull(x) and pd.notnull(row['fuzzy_street']) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score'] = temp_swisshotels.apply(
-                lambda r: (r['fuzzy_score_all'] + r['fuzzy_score_name'] + r['fuzzy_score_street']) / 3, axis=1)
+            return (matrices['all'] + matrices['name'] + matrices['street']) / 3
         elif algo == Matching.ALL_P_DYNAMIC:
-            temp_swisshotels.loc[:, 'fuzzy_score_all'] = temp_swisshotels['sh_fuzzy'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy'], x) if pd.notnull(x) else 0.0)
-            temp_swisshotels.loc[:, 'fuzzy_score_name'] = temp_swisshotels['sh_fuzzy_name'].apply(
-                lambda x: self.compare_two_strings(row['fuzzy_name'], x) if pd.notnull(x) else 0.0)
-            counter = 2
-            # Calculate the street score only if we have a street
-            if pd.notnull(row['fuzzy_street']):
-                temp_swisshotels.loc[:, 'fuzzy_score_street'] = temp_swisshotels['sh_fuzzy_street'].apply(
-                    lambda x: self.compare_two_strings(row['fuzzy_street'], x) if pd.notnull(x) and pd.notnull(
-                        row['fuzzy_street']) else 0.0)
-                counter += 1
+            # Only divide by the number of fields which are available for the hotel
+            return (matrices['all'] + matrices['name'] + matrices['street'] + matrices['city']) / field_counts[:, None]
+        raise ValueError('Unrecognized matching algorithm code')
+
+    def score_fuzzy_block(self, hotels, swisshotels, algo):
+        """
+        Batch scoring engine: scores a block of hotels against a block of candidate swisshotels
+        :param hotels: DataFrame containing the fuzzy fields of the hotels
+        :param swisshotels: DataFrame containing the fuzzy fields of the candidate swisshotels
+        :param algo: Matching algorithm code
+        :return: numpy array of shape (len(hotels), len(swisshotels)) with the final scores
+        """
+        if algo not in self.MATCHING_COMPONENTS:
+            raise ValueError('Unrecognized matching algorithm code')
+        matrices = self.create_fuzzy_score_matrices(hotels, swisshotels, self.MATCHING_COMPONENTS[algo])
+        return self.combine_fuzzy_scores(matrices, algo, self.count_fuzzy_fields(hotels))
+
+    def length_bound_matrix(self, queries, candidates):
+        """
+        Upper bound of the ratio of every pair of strings which only depends on their lengths, it is the same value
+        as SequenceMatcher.real_quick_ratio. Missing strings get a bound of 0 like their score.
+        :param queries: numpy array of fuzzy strings from the hotels
+        :param candidates: numpy array of fuzzy strings from the swisshotels
+        :return: numpy array of shape (len(queries), len(candidates))
+        """
+        query_lengths = np.array([len(a) if pd.notnull(a) else -1 for a in queries], dtype=float)
+        candidate_lengths = np.array([len(b) if pd.notnull(b) else -1 for b in candidates], dtype=float)
+        total = query_lengths[:, None] + candidate_lengths[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bounds = 2.0 * np.minimum(query_lengths[:, None], candidate_lengths[None, :]) / total
+        bounds[total == 0] = 1.0
+        bounds[(query_lengths < 0)[:, None] | (candidate_lengths < 0)[None, :]] = 0.0
+        return bounds
+
+    def score_column(self, matcher, queries, candidate, method):
+        """
+        Score several queries against a single candidate which has already been set as second sequence of the matcher
+        :param matcher: SequenceMatcher whose second sequence is the candidate
+        :param queries: numpy array of fuzzy strings from the hotels
+        :param candidate: fuzzy string of the swisshotel
+        :param method: name of the SequenceMatcher method used, 'quick_ratio' or 'ratio'
+        :return: numpy array of shape (len(queries), 1)
+        """
+        scores = np.zeros((len(queries), 1))
+        if pd.isnull(candidate):
+            return scores
+        for i, a in enumerate(queries):
+            if pd.notnull(a):
+                matcher.set_seq1(a)
+                scores[i, 0] = getattr(matcher, method)()
+        return scores
+
+    def find_best_in_fuzzy_block(self, hotels, swisshotels, algo):
+        """
+        Cascaded version of score_fuzzy_block which only returns the best candidate of every hotel. The candidates
+        are visited in order and a pair is rejected as soon as an upper bound of its score (first from the string
+        lengths, then from the character counts) is not above the best score found so far for the hotel. As only
+        rejected pairs are skipped and ties keep the first candidate, the result is identical to taking the argmax
+        of score_fuzzy_block.
+        :param hotels: DataFrame containing the fuzzy fields of the hotels
+        :param swisshotels: DataFrame containing the fuzzy fields of the candidate swisshotels
+        :param algo: Matching algorithm code
+        :return: tuple of (position of the best candidate, best score, number of pairs which were not fully compared)
+        """
+        if algo not in self.MATCHING_COMPONENTS:
+            raise ValueError('Unrecognized matching algorithm code')
+        components = self.MATCHING_COMPONENTS[algo]
+        field_counts = self.count_fuzzy_fields(hotels)
+        queries = {}
+        strings = {}
+        bounds = {}
+        for component in components:
+            hotel_field, swisshotel_field = self.FUZZY_COMPONENTS[component]
+            if hotel_field in hotels.keys():
+                queries[component] = hotels[hotel_field].values
             else:
-                temp_swisshotels.loc[:, 'fuzzy_score_street'] = 0.0
-            # Calculate the city score only if we have a city
-            if pd.notnull(row['fuzzy_city']):
-                temp_swisshotels.loc[:, 'fuzzy_score_city'] = temp_swisshotels['sh_fuzzy_city'].apply(
-                    lambda x: self.compare_two_strings(row['fuzzy_city'], x) if pd.notnull(x) and pd.notnull(
-                        row['fuzzy_city']) else 0.0)
-                counter += 1
+                queries[component] = np.array([np.NaN] * len(hotels), dtype=object)
+            strings[component] = swisshotels[swisshotel_field].values
+            bounds[component] = self.length_bound_matrix(queries[component], strings[component])
+        length_bounds = self.combine_fuzzy_scores(bounds, algo, field_counts)
+        matchers = dict((component, SM(None)) for component in components)
+        best_positions = np.zeros(len(hotels), dtype=int)
+        # Every score is at least 0, so the first candidate is always compared
+        best_scores = np.full(len(hotels), -1.0)
+        skipped = 0
+        for j in range(len(swisshotels)):
+            rows = np.flatnonzero(length_bounds[:, j] > best_scores)
+            skipped += len(hotels) - len(rows)
+            if len(rows) == 0:
+                continue
+            for component in components:
+                if pd.notnull(strings[component][j]):
+                    matchers[component].set_seq2(strings[component][j])
+            for method in ['quick_ratio', 'ratio']:
+                scores = dict((component, self.score_column(matchers[component], queries[component][rows],
+                                                            strings[component][j], method))
+                              for component in components)
+                scores = self.combine_fuzzy_scores(scores, algo, field_counts[rows])[:, 0]
+                better = scores > best_scores[rows]
+                if method == 'quick_ratio':
+                    skipped += len(rows) - better.sum()
+                    rows = rows[better]
+                else:
+                    best_scores[rows[better]] = scores[better]
+                    best_positions[rows[better]] = j
+        return best_positions, best_scores, skipped
+
+    def get_matching_fields(self, tripadvisor):
+        """
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :return: tuple of the name of the id field and the name of the postal code field
+        """
+        if tripadvisor:
+            return 'taid', 'ta_postalcode'
+        return 'tempid', 'all_postalcode'
+
+    def get_candidate_blocks(self, hotel_data, postalcode_name, candidates=Candidates.POSTALCODE):
+        """
+        Choose the candidate swisshotels of every hotel and group the hotels which share the same candidates.
+        Hotels without fuzzy string are never matched, hotels without postal code only if the trigram or grid index
+        is used (the grid index needs the coordinates 'x' and 'y' of the hotel).
+        :param hotel_data: DataFrame containing the postal code, fuzzy fields and optionally coordinates of the hotels
+        :param postalcode_name: name of the postal code field in hotel_data
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :return: list of (row positions in hotel_data, row positions in swisshotels) pairs
+        """
+        if self.postalcode_index is None:
+            self.create_postalcode_index()
+        has_fuzzy = hotel_data['fuzzy'].notnull().values
+        codes = hotel_data[postalcode_name].values
+        has_code = pd.notnull(codes)
+        blocks = {}
+        if candidates == Candidates.POSTALCODE:
+            # All rows with the same postal code share the same block
+            for pos in np.flatnonzero(has_fuzzy & has_code):
+                blocks.setdefault(int(codes[pos]), []).append(pos)
+            return [(positions, self.postalcode_index.candidates(code, self.POSTALCODE_DISTANCE))
+                    for code, positions in blocks.items()]
+        if candidates in [Candidates.GRID, Candidates.POSTALCODE_GRID]:
+            if self.grid_index is None:
+                self.create_grid_index()
+            use_code = has_code if candidates == Candidates.POSTALCODE_GRID else np.zeros(len(hotel_data), dtype=bool)
+            for pos in np.flatnonzero(has_fuzzy & use_code):
+                blocks.setdefault(('code', int(codes[pos])), []).append(pos)
+            if 'x' in hotel_data.keys() and 'y' in hotel_data.keys():
+                # Coordinates are sometimes stored as strings
+                xs = pd.to_numeric(hotel_data['x'], errors='coerce').values
+                ys = pd.to_numeric(hotel_data['y'], errors='coerce').values
+                rows = np.flatnonzero(has_fuzzy & ~use_code & ~np.isnan(xs) & ~np.isnan(ys))
+                for pos, cell in zip(rows, self.grid_index.cells(xs[rows], ys[rows])):
+                    blocks.setdefault(('cell', cell), []).append(pos)
+            return [(positions, self.postalcode_index.candidates(value, self.POSTALCODE_DISTANCE) if kind == 'code'
+                     else self.grid_index.candidates(value)) for (kind, value), positions in blocks.items()]
+        if candidates not in [Candidates.TRIGRAM, Candidates.POSTALCODE_TRIGRAM]:
+            raise ValueError('Unrecognized candidate generation code')
+        if self.trigram_index is None:
+            self.create_trigram_index()
+        rows = np.flatnonzero(has_fuzzy)
+        nearest = self.trigram_index.candidates(hotel_data['fuzzy'].iloc[rows], self.TRIGRAM_CANDIDATES)
+        for pos, candidate_positions in zip(rows, nearest):
+            if candidates == Candidates.POSTALCODE_TRIGRAM and has_code[pos]:
+                candidate_positions = np.union1d(candidate_positions, self.postalcode_index.candidates(
+                    int(codes[pos]), self.POSTALCODE_DISTANCE))
+            blocks.setdefault(tuple(candidate_positions), []).append(pos)
+        return [(positions, np.array(key, dtype=int)) for key, positions in blocks.items()]
+
+    def find_best_fuzzy_matches(self, hotel_data, algo, tripadvisor=False, candidates=Candidates.POSTALCODE,
+                                early_rejection=False):
+        """
+        Find the best matching swisshotel for every row. All rows with the same candidates (with the postal code
+        index, all rows with the same postal code) are scored together in a single call of the scoring engine.
+        :param hotel_data: DataFrame containing the id, postal code and fuzzy fields of the hotels
+        :param algo: Matching algorithm code
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :param early_rejection: Skip the full comparison of pairs which cannot beat the best score, see
+                                find_best_in_fuzzy_block. The counts are added to fuzzy_comparisons(_skipped)
+        :return: DataFrame with the id, the best swissid and its score for every row, in the order of hotel_data
+        """
+        id_name, postalcode_name = self.get_matching_fields(tripadvisor)
+        swissids = np.full(len(hotel_data), np.NaN)
+        scores = np.full(len(hotel_data), np.NaN)
+        for positions, candidate_positions in self.get_candidate_blocks(hotel_data, postalcode_name, candidates):
+            if len(candidate_positions) == 0:
+                continue
+            swisshotels = self.swisshotels.iloc[candidate_positions]
+            self.fuzzy_comparisons += len(positions) * len(candidate_positions)
+            if early_rejection:
+                best, best_scores, skipped = self.find_best_in_fuzzy_block(hotel_data.iloc[positions], swisshotels,
+                                                                           algo)
+                self.fuzzy_comparisons_skipped += skipped
             else:
-                temp_swisshotels.loc[:, 'fuzzy_score_city'] = 0.0
-            temp_swisshotels.loc[:, 'fuzzy_score'] = temp_swisshotels.apply(
-                lambda r: (r['fuzzy_score_all'] + r['fuzzy_score_name'] + r['fuzzy_score_street'] + r['fuzzy_score_city']) / counter, axis=1)
+                block_scores = self.score_fuzzy_block(hotel_data.iloc[positions], swisshotels, algo)
+                best = block_scores.argmax(axis=1)
+                best_scores = block_scores[np.arange(len(positions)), best]
+            swissids[positions] = swisshotels['swissid'].values[best]
+            scores[positions] = best_scores
+        return DataFrame({id_name: hotel_data[id_name].values, 'swissid': swissids, 'score': scores},
+                         columns=[id_name, 'swissid', 'score'])
+
+    def create_matching_pool(self, workers):
+        """
+        Start the worker processes for find_best_fuzzy_matches_parallel, every worker receives the swisshotel
+        candidate table and the candidate indexes once. Build the indexes first, see create_candidate_indexes.
+        :param workers: Number of worker processes
+        :return: the Pool, close and join it when the matching is done
+        """
+        # Only send the fields needed for scoring to the workers
+        fuzzy_fields = self.FUZZY_COMPONENTS.values()
+        swisshotel_fields = ['swissid', 'sh_code'] + [f for _, f in fuzzy_fields if f in self.swisshotels.keys()] + \
+                            [f for f in ['sh_x', 'sh_y'] if f in self.swisshotels.keys()]
+        return Pool(workers, _init_matching_worker, (self.swisshotels[swisshotel_fields], self.trigram_index,
+                                                     self.grid_index))
+
+    def find_best_fuzzy_matches_parallel(self, hotel_data, algo, tripadvisor=False, candidates=Candidates.POSTALCODE,
+                                         workers=1, chunk_size=100, early_rejection=False, pool=None):
+        """
+        Same as find_best_fuzzy_matches, but the rows are split into chunks which are scored by a pool of worker
+        processes. Every worker receives the swisshotel candidate table once when it is started, the results of
+        the chunks are merged back in their original order, so the output is identical to the serial one.
+        :param hotel_data: DataFrame containing the id, postal code and fuzzy fields of the hotels
+        :param algo: Matching algorithm code
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :param workers: Number of worker processes, with one worker the matching is done in this process
+        :param chunk_size: Number of hotel rows sent to a worker at once
+        :param early_rejection: Skip the full comparison of pairs which cannot beat the best score
+        :param pool: Pool of create_matching_pool which is reused for several calls, None to start one for this call
+        :return: DataFrame with the id, the best swissid and its score for every row, in the order of hotel_data
+        """
+        if workers <= 1 or len(hotel_data) <= chunk_size:
+            return self.find_best_fuzzy_matches(hotel_data, algo, tripadvisor, candidates, early_rejection)
+        id_name, postalcode_name = self.get_matching_fields(tripadvisor)
+        # Only send the fields needed for scoring to the workers
+        hotel_fields = [id_name, postalcode_name] + \
+                       [f for f, _ in self.FUZZY_COMPONENTS.values() if f in hotel_data.keys()] + \
+                       [f for f in ['x', 'y'] if f in hotel_data.keys()]
+        hotel_data = hotel_data[hotel_fields]
+        chunks = [(hotel_data.iloc[i:i+chunk_size], algo, tripadvisor, candidates, early_rejection)
+                  for i in range(0, len(hotel_data), chunk_size)]
+        print("Matching " + str(len(hotel_data)) + " hotels in " + str(len(chunks)) + " chunks with " + str(workers) + " workers")
+        if pool is not None:
+            results = pool.map(_match_chunk, chunks, 1)
         else:
-            raise ValueError('Unrecognized matching algorithm code')
-
-        maxid = temp_swisshotels.swissid[temp_swisshotels.fuzzy_score.argmax()]
-        maxscore = temp_swisshotels.fuzzy_score.max()
-        return pd.Series({id_name : row[id_name], 'swissid': maxid, 'score': maxscore})
-
-
-    def create_matching_by_fuzzy(self, filename = None, hotel_fields=['tempid', 'fuzzy', 'fuzzy_name' ,'fuzzy_street', 'all_name', 'all_street', 'all_postalcode'], swisshotel_fields = ['sh_name', 'sh_street', 'sh_code', 'sh_city', 'sh_fuzzy', 'sh_fuzzy_name', 'sh_fuzzy_street', 'swissid'], algorithm = Matching.ALL):
-        # Create the fuzzy strings for swisshotel and hotel data
-        self.create_fuzzy_strings()
+            pool = self.create_matching_pool(workers)
+            try:
+                # map returns the results in the order of the chunks
+                results = pool.map(_match_chunk, chunks, 1)
+            finally:
+                pool.close()
+                pool.join()
+        for _, comparisons, skipped in results:
+            self.fuzzy_comparisons += comparisons
+            self.fuzzy_comparisons_skipped += skipped
+        return pd.concat([matches for matches, _, _ in results], ignore_index=True)
+
+    def print_fuzzy_comparisons(self):
+        """
+        Print how many full comparisons were skipped by the early rejection and reset the counters
+        :return: None
+        """
+        if self.fuzzy_comparisons_skipped > 0:
+            print("Early rejection skipped " + str(self.fuzzy_comparisons_skipped) + " of " +
+                  str(self.fuzzy_comparisons) + " full comparisons")
+        self.fuzzy_comparisons = 0
+        self.fuzzy_comparisons_skipped = 0
+
+    def find_best_fuzzy_match(self, row, algo, tripadvisor=False, candidates=Candidates.POSTALCODE):
+        """
+        Find the best matching swisshotel for a single hotel
+        :param row: Series containing the id, postal code and fuzzy fields of the hotel
+        :param algo: Matching algorithm code
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :return: Series with the id, the best swissid and its score
+        """
+        return self.find_best_fuzzy_matches(DataFrame([row]), algo, tripadvisor, candidates).iloc[0]
+
+    def find_best_fuzzy_matches_all_algorithms(self, hotel_data, tripadvisor=False, candidates=Candidates.POSTALCODE,
+                                               algorithms=None):
+        """
+        Find the best matching swisshotel for every row with several matching algorithms at once. The score matrix of
+        each component is only computed once per block and shared by all the algorithms.
+        :param hotel_data: DataFrame containing the id, postal code and fuzzy fields of the hotels
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :param algorithms: List of matching algorithm codes, by default all of them
+        :return: DataFrame with the id and for every algorithm the fields 'swissid_<name>' and 'score_<name>', where
+                 name is taken from Matching.NAMES
+        """
+        if algorithms is None:
+            algorithms = sorted(self.MATCHING_COMPONENTS.keys())
+        components = sorted(set(c for algo in algorithms for c in self.MATCHING_COMPONENTS[algo]))
+        id_name, postalcode_name = self.get_matching_fields(tripadvisor)
+        swissids = dict((algo, np.full(len(hotel_data), np.NaN)) for algo in algorithms)
+        scores = dict((algo, np.full(len(hotel_data), np.NaN)) for algo in algorithms)
+        for positions, candidate_positions in self.get_candidate_blocks(hotel_data, postalcode_name, candidates):
+            if len(candidate_positions) == 0:
+                continue
+            hotels = hotel_data.iloc[positions]
+            swisshotels = self.swisshotels.iloc[candidate_positions]
+            matrices = self.create_fuzzy_score_matrices(hotels, swisshotels, components)
+            field_counts = self.count_fuzzy_fields(hotels)
+            for algo in algorithms:
+                block_scores = self.combine_fuzzy_scores(matrices, algo, field_counts)
+                best = block_scores.argmax(axis=1)
+                swissids[algo][positions] = swisshotels['swissid'].values[best]
+                scores[algo][positions] = block_scores[np.arange(len(positions)), best]
+        result = DataFrame({id_name: hotel_data[id_name].values})
+        for algo in algorithms:
+            result['swissid_' + Matching.NAMES[algo]] = swissids[algo]
+            result['score_' + Matching.NAMES[algo]] = scores[algo]
+        return result
+
+    def create_match_fingerprints(self, hotel_data, algo, tripadvisor=False, candidates=Candidates.POSTALCODE):
+        """
+        Fingerprint of everything the match of a row depends on: the matching algorithm, the candidate generation,
+        the fuzzy fields of the hotel and the swissids and fuzzy fields of its candidate block
+        :param hotel_data: DataFrame containing the id, postal code and fuzzy fields of the hotels
+        :param algo: Matching algorithm code
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :return: numpy array with one fingerprint string per row
+        """
+        id_name, postalcode_name = self.get_matching_fields(tripadvisor)
+        components = self.MATCHING_COMPONENTS[algo]
+        hotel_fields = [self.FUZZY_COMPONENTS[c][0] for c in components if self.FUZZY_COMPONENTS[c][0] in hotel_data.keys()]
+        swisshotel_fields = ['swissid'] + [self.FUZZY_COMPONENTS[c][1] for c in components]
+        row_hashes = pd.util.hash_pandas_object(hotel_data[hotel_fields], index=False).values
+        # Rows which are not in any block have no candidates
+        block_hashes = np.array([''] * len(hotel_data), dtype=object)
+        for positions, candidate_positions in self.get_candidate_blocks(hotel_data, postalcode_name, candidates):
+            block = pd.util.hash_pandas_object(self.swisshotels[swisshotel_fields].iloc[candidate_positions], index=False)
+            block_hashes[positions] = hashlib.md5(block.values.tobytes()).hexdigest()
+        prefix = str(algo) + ':' + str(candidates) + ':'
+        return np.array([prefix + '%016x' % row + ':' + block for row, block in zip(row_hashes, block_hashes)],
+                        dtype=object)
+
+    def load_match_store(self, filename):
+        """
+        Read a store of previous matches from the disk, start with an empty one if the file does not exist yet
+        :param filename: path to the pickled store
+        :return: DataFrame indexed by the hotel id with the fields 'fingerprint', 'swissid' and 'score'
+        """
+        if os.path.exists(filename):
+            return pd.read_pickle(filename)
+        return DataFrame(columns=['fingerprint', 'swissid', 'score'])
+
+    def update_match_store(self, store, rescored, filename):
+        """
+        Replace the stored matches of the rescored rows and write the store to the disk
+        :param store: DataFrame of the match store, see load_match_store
+        :param rescored: list of DataFrames of rescored rows in the format of the store, later rows win
+        :param filename: path to the pickled store
+        :return: the updated store
+        """
+        rescored = [new for new in rescored if len(new) > 0]
+        if len(rescored) == 0:
+            return store
+        new = pd.concat(rescored)
+        new = new[~new.index.duplicated(keep='last')]
+        store = pd.concat([store[~store.index.isin(new.index)], new])
+        self.create_parent_directory(filename)
+        store.to_pickle(filename)
+        return store
+
+    def find_best_fuzzy_matches_from_store(self, hotel_data, algo, store, tripadvisor=False,
+                                           candidates=Candidates.POSTALCODE, workers=1, chunk_size=100,
+                                           early_rejection=False, pool=None):
+        """
+        Take the matches of the rows whose fingerprint (see create_match_fingerprints) did not change from the store,
+        only the other rows are scored again. The store itself is not changed.
+        :param store: DataFrame of the match store, see load_match_store
+        :param pool: Pool of create_matching_pool which is reused for several calls, None to start one if needed
+        :return: tuple of the DataFrame with the id, the best swissid and its score for every row, in the order of
+                 hotel_data, and the DataFrame of the rescored rows in the format of the store
+        """
+        id_name, _ = self.get_matching_fields(tripadvisor)
+        keys = hotel_data[id_name].apply(lambda x: str(x)).values
+        fingerprints = self.create_match_fingerprints(hotel_data, algo, tripadvisor, candidates)
+        stored = store.reindex(keys)
+        changed = np.flatnonzero(stored['fingerprint'].values != fingerprints)
+        swissids = stored['swissid'].values.astype(float)
+        scores = stored['score'].values.astype(float)
+        if len(changed) > 0:
+            rescored = self.find_best_fuzzy_matches_parallel(hotel_data.iloc[changed], algo, tripadvisor, candidates,
+                                                             workers, chunk_size, early_rejection, pool)
+            swissids[changed] = rescored['swissid'].values
+            scores[changed] = rescored['score'].values
+        new = DataFrame({'fingerprint': fingerprints[changed], 'swissid': swissids[changed],
+                         'score': scores[changed]}, index=keys[changed], columns=['fingerprint', 'swissid', 'score'])
+        print("Matching: " + str(len(hotel_data) - len(changed)) + " hotels taken from the match store, " +
+              str(len(changed)) + " rescored")
+        return DataFrame({id_name: hotel_data[id_name].values, 'swissid': swissids, 'score': scores},
+                         columns=[id_name, 'swissid', 'score']), new
+
+    def find_best_fuzzy_matches_incremental(self, hotel_data, algo, tripadvisor=False,
+                                            candidates=Candidates.POSTALCODE, workers=1, chunk_size=100,
+                                            early_rejection=False, match_store=None):
+        """
+        Same as find_best_fuzzy_matches_parallel, but the matches are kept in a store on the disk. Only rows whose
+        fingerprint (see create_match_fingerprints) changed since they were stored are scored again, the matches of
+        all other rows are taken from the store.
+        :param hotel_data: DataFrame containing the id, postal code and fuzzy fields of the hotels
+        :param algo: Matching algorithm code
+        :param tripadvisor: Are we matching tripadvisor hotels or the hotel database
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :param workers: Number of worker processes
+        :param chunk_size: Number of hotel rows sent to a worker at once
+        :param early_rejection: Skip the full comparison of pairs which cannot beat the best score
+        :param match_store: path to the pickled match store, None to match every row
+        :return: DataFrame with the id, the best swissid and its score for every row, in the order of hotel_data
+        """
+        if match_store is None:
+            return self.find_best_fuzzy_matches_parallel(hotel_data, algo, tripadvisor, candidates, workers,
+                                                         chunk_size, early_rejection)
+        store = self.load_match_store(match_store)
+        result, new = self.find_best_fuzzy_matches_from_store(hotel_data, algo, store, tripadvisor, candidates,
+                                                              workers, chunk_size, early_rejection)
+        self.update_match_store(store, [new], match_store)
+        return result
+
+    def get_hotel_matching_data(self, filename, hotel_fields, candidates=Candidates.POSTALCODE):
+        """
+        Select the hotels which have to be matched, the fuzzy strings have to be created first
+        :param filename: Path to a CSV file with the subset of tempids to match, None to match all hotels
+        :param hotel_fields: Fields of the hotels which are needed for the matching
+        :param candidates: Candidates code, the coordinates of the hotels are added for the grid index
+        :return: DataFrame with the hotel fields of the hotels to match
+        """
+        if candidates in [Candidates.GRID, Candidates.POSTALCODE_GRID]:
+            hotel_fields = hotel_fields + [f for f in ['x', 'y'] if f in self.hotels.keys() and f not in hotel_fields]
         # Take the hotel data where it makes sense, only the entries with fuzzy fields
         hotel_data = self.hotels.loc[self.hotels['fuzzy'].notnull(),hotel_fields]
         # Check if we only need to match a special subset (indicated by a file)
@@ -1467,83 +2397,202 @@ class Database():
                 print("#samples: " + str(self.subset['tempid'].count()))
             # Only keep the data in the subset
             hotel_data = self.subset.merge(hotel_data, on='tempid', how='left')
+        return hotel_data
+
+    def create_matching_all_algorithms(self, filename = None, hotel_fields=['tempid', 'fuzzy', 'fuzzy_name' ,'fuzzy_street', 'all_name', 'all_street', 'all_postalcode'], candidates=Candidates.POSTALCODE):
+        """
+        Match the hotels with every matching algorithm in a single pass, the result is stored in matching_algorithms
+        :param filename: Path to a CSV file with the subset of tempids to match, None to match all hotels
+        :param hotel_fields: Fields of the hotels which are kept in the result
+        :param candidates: Candidates code, how the candidate swisshotels are chosen
+        :return: None
+        """
+        self.create_fuzzy_strings()
+        self.create_candidate_indexes(candidates)
+        hotel_data = self.get_hotel_matching_data(filename, hotel_fields, candidates)
+        scores = self.find_best_fuzzy_matches_all_algorithms(hotel_data, candidates=candidates)
+        self.matching_algorithms = hotel_data.merge(scores.drop_duplicates('tempid'), on='tempid', how='left')
+
+    def validate_matching_algorithms(self):
+        """
+        Validate every algorithm of matching_algorithms with validate_matching, the hotels need a 'swissid_corrected'
+        field (the test sample has one)
+        :return: DataFrame with the best cutoff, its accuracy and precision for every algorithm
+        """
+        if self.matching_algorithms is None:
+            raise ValueError('The matching of all algorithms has to be created first before it can be validated...')
+        matching, cutoff = self.matching, self.matching_cutoff
+        results = []
+        for algo in sorted(Matching.NAMES.keys()):
+            name = Matching.NAMES[algo]
+            if 'score_' + name not in self.matching_algorithms.keys():
+                continue
+            self.matching = self.matching_algorithms.rename(columns={'swissid_' + name: 'swissid', 'score_' + name: 'score'})
+            self.matching = self.matching.loc[self.matching['swissid'].notnull(), :]
+            curve = self.validate_matching(verbose=False)
+            best = curve['accuracy'].values.argmax()
+            results += [(name, curve['cutoff'][best], curve['accuracy'][best], curve['precision'][best])]
+            print(name + ": accuracy " + str(curve['accuracy'][best]) + " at cutoff " + str(curve['cutoff'][best]))
+        self.matching, self.matching_cutoff = matching, cutoff
+        return DataFrame(results, columns=['algorithm', 'cutoff', 'accuracy', 'precision'])
+
+    def create_matching_by_fuzzy(self, filename = None, hotel_fields=['tempid', 'fuzzy', 'fuzzy_name' ,'fuzzy_street', 'all_name', 'all_street', 'all_postalcode'], swisshotel_fields = ['sh_name', 'sh_street', 'sh_code', 'sh_city', 'sh_fuzzy', 'sh_fuzzy_name', 'sh_fuzzy_street', 'swissid'], algorithm = Matching.ALL, candidates=Candidates.POSTALCODE, workers=1, chunk_size=100, early_rejection=False, match_store=None):
+        # Create the fuzzy strings for swisshotel and hotel data
+        self.create_fuzzy_strings()
+        self.create_candidate_indexes(candidates)
+        hotel_data = self.get_hotel_matching_data(filename, hotel_fields, candidates)
 
         # Create the matching
-        all_names_scores = hotel_data.apply(lambda row: self.find_best_fuzzy_match(row, algorithm), axis=1)
+        all_names_scores = self.find_best_fuzzy_matches_incremental(hotel_data, algorithm, candidates=candidates,
+                                                                    workers=workers, chunk_size=chunk_size,
+                                                                    early_rejection=early_rejection,
+                                                                    match_store=match_store)
+        self.print_fuzzy_comparisons()
         all_names = hotel_data.merge(all_names_scores, on='tempid', how='left')
         self.matching = all_names.loc[all_names['swissid'].notnull(),:].merge(
             self.swisshotels[swisshotel_fields], on='swissid', how='left')
 
-    def create_matching_tripadvisor_hotels(self, input_tripadvisor, output_matching, algorithm=Matching.ALL, swisshotel_fields = ['sh_name', 'sh_street', 'sh_code', 'sh_city', 'sh_fuzzy', 'sh_fuzzy_name', 'sh_fuzzy_street', 'swissid']):
+    def create_matching_tripadvisor_hotels(self, input_tripadvisor, output_matching, algorithm=Matching.ALL, swisshotel_fields = ['sh_name', 'sh_street', 'sh_code', 'sh_city', 'sh_fuzzy', 'sh_fuzzy_name', 'sh_fuzzy_street', 'swissid'], candidates=Candidates.POSTALCODE, workers=1, chunk_size=100, early_rejection=False, match_store=None, stream_size=2000, store_interval=10):
         """
-
+        Match all the tripadvisor hotels with the swisshotels. The hotels are matched in chunks of stream_size rows and
+        the matches of each chunk are appended to the output file as soon as it is done, so only one chunk of results
+        is held in memory at a time.
         :param input_tripadvisor: Path to the files with tripadvisor data, especially name and address
         :param output_matching: Path to a CSV file where the matched IDs will be stored
+        :param candidates: Candidates code, how the candidate swisshotels are chosen. Hotels with a missing or
+                           invalid postal code are only kept if the trigram or grid index is used
+        :param workers: Number of processes used for the matching
+        :param chunk_size: Number of hotels handed to a process at once
+        :param early_rejection: Skip the full comparison of pairs which cannot beat the best score found so far
+        :param match_store: Path to a store of previous matches, only hotels whose fields or candidates changed
+                            are matched again
+        :param stream_size: Number of hotels matched before their results are written to the output file
+        :param store_interval: Number of chunks after which the rescored matches are written to the match store, the
+                               store is read once and written again at the end
         :return:
         """
         if self.tripadvisor_hotels is None:
             self.tripadvisor_hotels = pd.read_csv(input_tripadvisor, encoding='utf-8-sig')
         # Remove hotels which will lead to trouble due to unusal zip codes
-        self.tripadvisor_hotels = self.tripadvisor_hotels[self.tripadvisor_hotels['ta_postalcode'] < 10000]
-        self.tripadvisor_hotels = self.tripadvisor_hotels[self.tripadvisor_hotels['ta_postalcode'] > 999]
-        self.tripadvisor_hotels = self.tripadvisor_hotels.head(200)
+        invalid_code = ~((self.tripadvisor_hotels['ta_postalcode'] < 10000) & (self.tripadvisor_hotels['ta_postalcode'] > 999))
+        if candidates == Candidates.POSTALCODE:
+            self.tripadvisor_hotels = self.tripadvisor_hotels[~invalid_code]
+        else:
+            # The trigram and grid indexes can still find candidates, only the postal code is unusable
+            self.tripadvisor_hotels.loc[invalid_code, 'ta_postalcode'] = np.NaN
         # Prepare fuzzy strings in both datasets
         self.create_fuzzy_strings(tripadvisor=True, hotels=False, swisshotels=True)
-        all_names_scores = self.tripadvisor_hotels.apply(lambda row: self.find_best_fuzzy_match(row, algorithm, tripadvisor=True), axis=1)
-        all_names = self.tripadvisor_hotels.merge(all_names_scores, on='taid', how='left')
-        tripadvisor = all_names.loc[all_names['swissid'].notnull(), :].merge(
-            self.swisshotels[swisshotel_fields], on='swissid', how='left')
-        tripadvisor.to_csv(output_matching, index=False, encoding='utf-8-sig')
+        self.create_candidate_indexes(candidates)
+        total = len(self.tripadvisor_hotels)
+        store = self.load_match_store(match_store) if match_store is not None else None
+        rescored = []
+        # The workers are started once and receive the swisshotels once for all the chunks
+        pool = self.create_matching_pool(workers) if workers > 1 else None
+        start = time.time()
+        try:
+            for chunk_number, i in enumerate(range(0, max(total, 1), stream_size)):
+                chunk = self.tripadvisor_hotels.iloc[i:i+stream_size]
+                if store is None:
+                    all_names_scores = self.find_best_fuzzy_matches_parallel(chunk, algorithm, True, candidates,
+                                                                             workers, chunk_size, early_rejection,
+                                                                             pool)
+                else:
+                    all_names_scores, new = self.find_best_fuzzy_matches_from_store(chunk, algorithm, store, True,
+                                                                                    candidates, workers, chunk_size,
+                                                                                    early_rejection, pool)
+                    rescored.append(new)
+                    if (chunk_number + 1) % store_interval == 0:
+                        store = self.update_match_store(store, rescored, match_store)
+                        rescored = []
+                all_names = chunk.merge(all_names_scores.drop_duplicates('taid'), on='taid', how='left')
+                tripadvisor = all_names.loc[all_names['swissid'].notnull(), :].merge(
+                    self.swisshotels[swisshotel_fields], on='swissid', how='left')
+                # The first chunk creates the file with header and byte order mark, the others are appended
+                if i == 0:
+                    tripadvisor.to_csv(output_matching, index=False, encoding='utf-8-sig')
+                else:
+                    tripadvisor.to_csv(output_matching, index=False, encoding='utf-8', mode='a', header=False)
+                done = i + len(chunk)
+                elapsed = time.time() - start
+                remaining = elapsed / done * (total - done) if done > 0 else 0.0
+                print("Matched " + str(done) + " of " + str(total) + " tripadvisor hotels, " + str(int(elapsed)) +
+                      "s elapsed, about " + str(int(remaining)) + "s remaining")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if store is not None:
+            self.update_match_store(store, rescored, match_store)
+        self.print_fuzzy_comparisons()
         print("Stored the matching between tripadvisor and swisshotel at " + output_matching)
 
-    def find_closest_match(self, target, database, id):
-        """
-        Find the point which is closest to the target
-        :param target: The point for which we need to find the closest match (x,y)
-        :param database: A dataframe containing the 'id' field plus 'x' and 'y' coordinates corresponding to it
-        :param id: The name of the id field
-        :return: returns the content of the 'id' field for the closest match
-        """
-        x,y = target
-        database.loc[:, 'distance'] = database.apply(
-            lambda line: sqrt(pow(x-float(line['x']), 2)+pow(y-float(line['y']), 2)), axis=1)
-        pos = database['distance'].argmin()
-        return database[id][pos]
-
-    def create_code_city_dictionaries_for_economic_data(self, key_code, key_city):
-        """
-
-        :param key_code:
-        :param key_city:
-        :return:
-        """
-        code_to_id = {}
-        city_to_id = {}
-        for elem in key_code:
-            dest = elem[0]
-            list = elem[1]
-            for nb in list:
-                code_to_id[nb.encode('utf-8')] = dest
-        for elem in key_city:
-            dest = elem[0]
-            city = elem[1].encode('utf-8').lower()
-            city_to_id[city] = dest
-        return code_to_id, city_to_id
-
-
-    def match_hotels_economic_data(self, input_economic_data_coordinates):
+    def create_economic_region_index(self, input_economic_data_coordinates, haversine=False, index_file=None):
+        """
+        Build the economic region index unless an index of the same data is already loaded or stored in index_file
+        :param input_economic_data_coordinates: path to the CSV with the coordinates of the economic regions
+        :param haversine: Use the great-circle distance to find the closest region
+        :param index_file: path where the pickled index is stored between runs, None to always build it
+        :return: the EconomicRegionIndex, also kept in economic_region_index
+        """
+        coordinates = pd.read_csv(input_economic_data_coordinates, encoding='utf-8')
+        source_hash = EconomicRegionIndex.create_source_hash(self.economic_data, coordinates)
+        index = self.economic_region_index
+        if (index is None or index.source_hash != source_hash or index.haversine != haversine) and \
+                index_file is not None and os.path.exists(index_file):
+            index = pd.read_pickle(index_file)
+        if index is None or index.source_hash != source_hash or index.haversine != haversine:
+            index = EconomicRegionIndex(self.economic_data, coordinates, haversine)
+            if index_file is not None:
+                self.create_parent_directory(index_file)
+                pd.to_pickle(index, index_file)
+        self.economic_region_index = index
+        return index
+
+    def combine_available_fields(self, df, fields):
+        """
+        :param df: DataFrame
+        :param fields: list of field names in order of preference, fields which are not in df are skipped
+        :return: Series with the first non null value of the fields for every row
+        """
+        combined = pd.Series(np.NaN, index=df.index, dtype=object)
+        for field in fields:
+            if field in df.keys():
+                combined = combined.fillna(df[field])
+        return combined
+
+    def fill_coordinates_from_gazetteer(self, xs, ys, codes, cities):
+        """
+        Fill the missing coordinates with the centroid of the postal code or city, if the gazetteer is set
+        :param xs: Series with the first coordinate, strings are converted and invalid entries count as missing
+        :param ys: Series with the second coordinate
+        :param codes: Series of postal codes with the index of xs
+        :param cities: Series of city names with the index of xs
+        :return: tuple of Series (xs, ys) as floats, the input unchanged if there is no gazetteer
+        """
+        if self.gazetteer is None:
+            return xs, ys
+        xs = pd.to_numeric(xs, errors='coerce').copy()
+        ys = pd.to_numeric(ys, errors='coerce').copy()
+        missing = np.flatnonzero((xs.isnull() | ys.isnull()).values)
+        located = 0
+        for position in missing:
+            geolocation = self.gazetteer.locate(codes.iloc[position], cities.iloc[position])
+            if geolocation is not None:
+                xs.iloc[position], ys.iloc[position] = geolocation[0], geolocation[1]
+                located += 1
+        print("Located " + str(located) + " of " + str(len(missing)) + " hotels without coordinates with the postal "
+              "code gazetteer")
+        return xs, ys
+
+    def match_hotels_economic_data(self, input_economic_data_coordinates, haversine=False, index_file=None):
         """
         Match the hotels with their economic region
         :param economic_data: path to the econmic data
+        :param haversine: Use the great-circle distance to find the closest region
+        :param index_file: path where the economic region index is stored between runs
         :return:
         """
-        economic_data = self.economic_data
-        economic_data_coordinates = pd.read_csv(input_economic_data_coordinates, encoding='utf-8')
-        economic_data.loc[:, 'ed_city_codes'] = economic_data['ed_city_codes'].apply(lambda x: x.split(','))
-        # Create dictionaries for matching where the city or zip code match
-        key_code = economic_data[['edid', 'ed_city_codes']].values
-        key_city = economic_data[['edid', 'ed_city']].values
-        code_to_id, city_to_id = self.create_code_city_dictionaries_for_economic_data(key_code, key_city)
+        index = self.create_economic_region_index(input_economic_data_coordinates, haversine, index_file)
         # Create city and zip code for matching according to priority: Google, Tripadvisor, own data
         self.hotels.loc[:, 'match_code'] = self.hotels['go_postalcode']
         self.hotels.loc[:, 'match_city'] = self.hotels['go_city'].str.lower()
@@ -1551,58 +2600,56 @@ class Database():
         self.hotels.loc[self.hotels['match_city'].isnull(), 'match_city'] = self.hotels['ta_city'].str.lower()
         self.hotels.loc[self.hotels['match_code'].isnull(), 'match_code'] = self.hotels['plz']
         self.hotels.loc[self.hotels['match_city'].isnull(), 'match_city'] = self.hotels['city'].str.lower()
-        # Try matching according to the city name
-        self.hotels.loc[:, 'edid'] = self.hotels['match_city'].apply(
-            lambda city: city_to_id[city] if city_to_id.has_key(city) else np.NaN)
-        print("Match with city name: " + str(self.hotels['edid'].notnull().sum()))
-        # Try matching according to the zip code
-        self.hotels.loc[self.hotels['edid'].isnull(), 'edid'] = self.hotels['match_code'].apply(
-            lambda code: code_to_id[code] if code_to_id.has_key(code) else np.NaN)
-        print("Match with code: " + str(self.hotels['edid'].notnull().sum()))
-        # Get the closest location if no match has been found
-        self.hotels.loc[self.hotels['edid'].isnull(), 'edid'] = self.hotels.apply(
-            lambda line: self.find_closest_match((float(line['x']), float(line['y'])), economic_data_coordinates, 'edid'), axis=1)
-        print("Match with NN: " + str(self.hotels['edid'].notnull().sum()))
+        # Match according to the city name, then the zip code and take the closest location for the rest
+        priority = ('city', 'code', 'nearest')
+        xs, ys = self.fill_coordinates_from_gazetteer(self.hotels['x'], self.hotels['y'], self.hotels['match_code'],
+                                                      self.hotels['match_city'])
+        regions = index.lookup(self.hotels['match_code'], self.hotels['match_city'], xs, ys, priority)
+        self.hotels.loc[:, 'edid'] = regions['edid']
+        self.print_economic_region_matches(regions, priority)
         # Store the matching
         self.hotel_economic_matching = self.hotels[['tempid', 'edid']]
 
-    def create_matching_tripadvisor_economic_data(self, input_tripadvisor, input_economic_data_coordinates, output_matching):
+    def create_matching_tripadvisor_economic_data(self, input_tripadvisor, input_economic_data_coordinates, output_matching, haversine=False, index_file=None):
         """
         Match the tripadvisor hotels with their economic data
         :param input_tripadvisor:
         :param input_economic_data_coordinates:
         :param output_matching:
+        :param haversine: Use the great-circle distance to find the closest region
+        :param index_file: path where the economic region index is stored between runs
         :return:
         """
         hotels = pd.read_csv(input_tripadvisor, encoding='utf-8-sig')
-        economic_data = self.economic_data
-        economic_data_coordinates = pd.read_csv(input_economic_data_coordinates, encoding='utf-8')
-        economic_data.loc[:, 'ed_city_codes'] = economic_data['ed_city_codes'].apply(lambda x: x.split(','))
-        # Create dictionaries for matching where the city or zip code match
-        key_code = economic_data[['edid', 'ed_city_codes']].values
-        key_city = economic_data[['edid', 'ed_city']].values
-        code_to_id, city_to_id = self.create_code_city_dictionaries_for_economic_data(key_code, key_city)
+        index = self.create_economic_region_index(input_economic_data_coordinates, haversine, index_file)
         # Prepare the relevant fields
         hotels.loc[:, 'match_code'] = hotels['ta_postalcode'].apply(lambda code: str(int(code)) if pd.notnull(code) else code)
         hotels.loc[:, 'match_city'] = hotels['ta_city'].str.lower()
-        # Try matching according to the zip code
-        hotels.loc[:, 'edid'] = hotels['match_code'].apply(
-            lambda code: code_to_id[code] if pd.notnull(code) and code_to_id.has_key(code) else np.NaN)
-        print("Match with code: " + str(hotels['edid'].notnull().sum()))
-        # Try matching according to the city name
-        hotels.loc[hotels['edid'].isnull(), 'edid'] = hotels['match_city'].apply(
-            lambda city: city_to_id[city] if pd.notnull(city) and city_to_id.has_key(city) else np.NaN)
-        print("Match with city name: " + str(hotels['edid'].notnull().sum()))
-        # Get the closest location if no match has been found
-        hotels.loc[hotels['edid'].isnull(), 'edid'] = hotels[hotels['edid'].isnull()].apply(
-            lambda line: self.find_closest_match((float(line['x']), float(line['y'])), economic_data_coordinates,
-                                                 'edid'), axis=1)
-        print("Match with NN: " + str(hotels['edid'].notnull().sum()))
+        # Match according to the zip code, then the city name and take the closest location for the rest
+        priority = ('code', 'city', 'nearest')
+        xs, ys = self.fill_coordinates_from_gazetteer(hotels['x'], hotels['y'], hotels['match_code'],
+                                                      hotels['match_city'])
+        regions = index.lookup(hotels['match_code'], hotels['match_city'], xs, ys, priority)
+        hotels.loc[:, 'edid'] = regions['edid']
+        self.print_economic_region_matches(regions, priority)
         # Store the matching
         hotels[['taid', 'edid']].to_csv(output_matching, index=False, encoding='utf-8-sig')
 
 
 
+    def print_economic_region_matches(self, regions, priority):
+        """
+        Print the cumulative number of hotels matched after each method of an economic region lookup
+        :param regions: DataFrame returned by EconomicRegionIndex.lookup
+        :param priority: order in which the methods were tried
+        :return: None
+        """
+        names = {'code': 'code', 'city': 'city name', 'nearest': 'NN'}
+        matched = 0
+        for method in priority:
+            matched += (regions['ed_match'] == method).sum()
+            print("Match with " + names[method] + ": " + str(matched))
+
     def store_hotel_econmic_data_matching(self, filename):
         """
 
@@ -1612,20 +2659,62 @@ class Database():
         self.hotel_economic_matching.to_csv(filename, index=False, encoding='utf-8-sig')
         print("Stored the matching between hotels and economic data to: " + filename)
 
-    def validate_matching(self):
+    def validate_matching(self, cutoffs=None, verbose=True):
+        """
+        Compute the accuracy and precision of the matching for a grid of score cutoffs in a single pass. A row is
+        correct if it is accepted (score above the cutoff) with the corrected swissid, or rejected while the
+        corrected swissid is -1. The scores are sorted once, so every cutoff only needs a lookup into cumulative
+        counts. The best cutoff is stored in matching_cutoff.
+        :param cutoffs: Sequence of cutoffs to evaluate, by default from 0.5 to 0.9 in steps of 0.001
+        :param verbose: Print the accuracy of every cutoff and the best cutoff
+        :return: DataFrame with the cutoff, number of accepted rows, number of correct rows, accuracy and precision
+        """
         if self.matching is None:
             raise ValueError('The matching has to be created first before it can be validated...')
-        total = self.matching['tempid'].count()
-        ts = []
-        for cutoff in np.arange(0.5,0.9,0.001):
-            self.matching['temp'] = self.matching.apply(lambda row: row['swissid'] if row['score'] > cutoff else -1, axis = 1)
-            correct = self.matching.loc[
-                self.matching['temp'] == self.matching['swissid_corrected'], 'tempid'].count()
-            percentage = (correct+0.0)/total
-            ts += [(cutoff, percentage)]
-
-        for a, b in ts:
-            print(str(a) + ", " + str(b))
+        if cutoffs is None:
+            cutoffs = np.arange(0.5,0.9,0.001)
+        cutoffs = np.asarray(cutoffs, dtype=float)
+        matching = self.matching.loc[self.matching['tempid'].notnull()]
+        total = len(matching)
+        # Rows without score are never accepted, sort them before every cutoff
+        scores = matching['score'].fillna(-np.inf).values
+        correct_if_accepted = (matching['swissid'] == matching['swissid_corrected']).values
+        correct_if_rejected = (matching['swissid_corrected'] == -1).values
+        order = np.argsort(scores, kind='mergesort')
+        scores = scores[order]
+        # accepted_correct[i] / gain[i]: sums over the rows from position i to the end of the sorted scores
+        accepted_correct = np.append(np.cumsum(correct_if_accepted[order][::-1])[::-1], 0)
+        gain = np.append(np.cumsum((correct_if_accepted.astype(int) - correct_if_rejected)[order][::-1])[::-1], 0)
+        first_accepted = np.searchsorted(scores, cutoffs, side='right')
+        accepted = total - first_accepted
+        correct = correct_if_rejected.sum() + gain[first_accepted]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            curve = DataFrame({'cutoff': cutoffs, 'accepted': accepted, 'correct': correct,
+                               'accuracy': (correct + 0.0) / total,
+                               'precision': (accepted_correct[first_accepted] + 0.0) / accepted},
+                              columns=['cutoff', 'accepted', 'correct', 'accuracy', 'precision'])
+        if verbose:
+            for a, b in zip(curve['cutoff'], curve['accuracy']):
+                print(str(a) + ", " + str(b))
+        if total > 0:
+            self.matching_cutoff = curve['cutoff'][curve['accuracy'].values.argmax()]
+            if verbose:
+                print("Best cutoff: " + str(self.matching_cutoff))
+        return curve
+
+    def apply_matching_cutoff(self, cutoff=None):
+        """
+        Remove the matches whose score is not above the cutoff
+        :param cutoff: Minimum score of a match, by default the best cutoff found by validate_matching
+        :return: None
+        """
+        if cutoff is None:
+            cutoff = self.matching_cutoff
+        if cutoff is None or self.matching is None:
+            return
+        accepted = self.matching['score'] > cutoff
+        print("Removed " + str((~accepted).sum()) + " matches with a score of at most " + str(cutoff))
+        self.matching = self.matching.loc[accepted, :]
 
     def merge_row(self, row):
         if 't' in row['swissid']:
@@ -1800,7 +2889,10 @@ class Database():
         self.swisshotels.loc[:, 'sh_full_address'] = self.swisshotels.apply(
             lambda row: row['sh_street'] + ", " + str(row['sh_code']) + " " + row['sh_city'] + ", Switzerland"
             if pd.notnull(row['sh_street']) else str(row['sh_code']) + " " + row['sh_city'] + ", Switzerland", axis=1)
-        self.swisshotels.loc[:, 'sh_coordinates'] = self.swisshotels['sh_full_address'].apply(lambda address: self.get_coordinates(address))
+        self.swisshotels.loc[:, 'sh_coordinates'] = self.geocode_addresses(self.swisshotels['sh_full_address'],
+                                                                           self.swisshotels['sh_code'],
+                                                                           self.swisshotels['sh_city'],
+                                                                           self.swisshotels['sh_street'].isnull())
         self.swisshotels[['swissid', 'sh_coordinates']].to_csv(output_file + 'raw.csv', index=False,
                                                                                encoding='utf-8-sig')
         # Split them up in a x and y part
@@ -2172,23 +3264,37 @@ class Database():
         print("Printed the bigger file to " + output_revenue)
 
 
+# Database of a matching worker process, it is created once per process by _init_matching_worker
+_matching_worker_database = None
 
 
+def _init_matching_worker(swisshotels, trigram_index, grid_index):
+    """
+    Initializer of the worker processes used by Database.find_best_fuzzy_matches_parallel
+    :param swisshotels: DataFrame with the swissid, postal code and fuzzy fields of the swisshotels
+    :param trigram_index: TrigramIndex over the same swisshotels or None if it is not used
+    :param grid_index: GridIndex over the same swisshotels or None if it is not used, built in the parent process
+    with its cell size
+    :return: None
+    """
+    global _matching_worker_database
+    _matching_worker_database = Database()
+    _matching_worker_database.swisshotels = swisshotels
+    _matching_worker_database.create_postalcode_index()
+    _matching_worker_database.trigram_index = trigram_index
+    _matching_worker_database.grid_index = grid_index
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def _match_chunk(task):
+    """
+    Match one chunk of hotels inside a worker process
+    :param task: tuple of (hotel_data, algorithm, tripadvisor, candidates, early_rejection)
+    :return: tuple of (DataFrame with the id, the best swissid and its score for every row of the chunk,
+             number of pairs, number of pairs which were not fully compared)
+    """
+    hotel_data, algo, tripadvisor, candidates, early_rejection = task
+    database = _matching_worker_database
+    database.fuzzy_comparisons = 0
+    database.fuzzy_comparisons_skipped = 0
+    matches = database.find_best_fuzzy_matches(hotel_data, algo, tripadvisor, candidates, early_rejection)
+    return matches, database.fuzzy_comparisons, database.fuzzy_comparisons_skipped
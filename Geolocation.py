@@ -0,0 +1,422 @@
+# This Python file uses the following encoding: utf-8
+import os
+import re
+import sqlite3
+import time
+import threading
+import requests
+import geocoder
+import pandas as pd
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import ReadTimeout, ConnectionError
+
+
+class GeocodingError(Exception):
+    """
+        The geocoding service answered with an error, e.g. an invalid key, the address is not known to be missing
+    """
+    pass
+
+
+class GeocodingUnavailable(GeocodingError):
+    """
+        The geocoding service could not answer for now, e.g. a timeout, a rate limit (429) or a server error (5xx), the
+        query can be retried
+    """
+    pass
+
+
+def raise_for_status_code(status_code, message):
+    """
+    :param status_code: HTTP status code of the answer of the geocoding service, None if no answer was received
+    :param message: description of the error
+    :return: None, raises GeocodingUnavailable if the query can be retried, GeocodingError for any other error
+    """
+    if status_code is None or status_code == 429 or status_code >= 500:
+        raise GeocodingUnavailable(message)
+    raise GeocodingError(message)
+
+
+class GeocodeCache():
+    """
+        Cache of geocoding results kept in a SQLite file, so the lookups survive between runs. Every entry has a
+        timestamp and expires after the time to live, if the cache grows over its maximal size the entries which have
+        not been used for the longest time are evicted. Failed lookups are kept in their own table and are only
+        retried after a backoff which doubles with every failure.
+        The changes and the access times of the hits are written in batches, call commit at the end of a run.
+    """
+
+    def __init__(self, filename, ttl=180*24*3600, max_entries=100000, failure_backoff=3600,
+                 max_failure_backoff=7*24*3600, commit_interval=1000):
+        """
+        :param filename: path to the SQLite file, it is created if it does not exist yet
+        :param ttl: time to live of an entry in seconds, None to keep the entries forever
+        :param max_entries: maximal number of successful lookups kept in the cache, None for no limit
+        :param failure_backoff: time in seconds to wait before an address is retried after its first failure
+        :param max_failure_backoff: maximal time in seconds to wait before a failed address is retried
+        :param commit_interval: number of operations after which the changes are committed
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.failure_backoff = failure_backoff
+        self.max_failure_backoff = max_failure_backoff
+        self.commit_interval = commit_interval
+        # Access times of the hits which are not written yet, by address
+        self.accessed = {}
+        self.pending = 0
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        # Allows addresses given as utf-8 encoded byte strings
+        self.connection.text_factory = str
+        self.connection.execute('CREATE TABLE IF NOT EXISTS geocodes (address TEXT PRIMARY KEY, lat REAL, lng REAL, '
+                                'created REAL, accessed REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS geocodes_accessed ON geocodes (accessed)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS failures (address TEXT PRIMARY KEY, error TEXT, '
+                                'attempts INTEGER, failed REAL, retry_after REAL)')
+        # The expired entries are removed once per run
+        self.evict()
+        self.connection.commit()
+
+    def get(self, address):
+        """
+        :param address: address which was geocoded
+        :return: the coordinates [lat, lng] if they are in the cache and not expired, None otherwise
+        """
+        row = self.connection.execute('SELECT lat, lng, created FROM geocodes WHERE address = ?',
+                                      (address,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.ttl is not None and row[2] + self.ttl < now:
+            return None
+        self.accessed[address] = now
+        self.operation()
+        return [row[0], row[1]]
+
+    def put(self, address, coordinates):
+        """
+        Store the coordinates of an address, a previous failure of the address is forgotten
+        :param address: address which was geocoded
+        :param coordinates: the coordinates [lat, lng]
+        :return: None
+        """
+        now = time.time()
+        self.connection.execute('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)',
+                                (address, coordinates[0], coordinates[1], now, now))
+        self.connection.execute('DELETE FROM failures WHERE address = ?', (address,))
+        self.accessed.pop(address, None)
+        self.operation()
+
+    def operation(self):
+        """
+        Count a change, the changes are committed every commit_interval operations
+        :return: None
+        """
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        """
+        Write the access times of the hits, evict the least recently used entries if the cache is over its maximal
+        size and commit all the changes
+        :return: None
+        """
+        if len(self.accessed) > 0:
+            self.connection.executemany('UPDATE geocodes SET accessed = ? WHERE address = ?',
+                                        [(accessed, address) for address, accessed in self.accessed.items()])
+            self.accessed = {}
+        if self.max_entries is not None and \
+                self.connection.execute('SELECT COUNT(*) FROM geocodes').fetchone()[0] > self.max_entries:
+            self.evict()
+        self.connection.commit()
+        self.pending = 0
+
+    def evict(self):
+        """
+        Remove the expired entries and, if there are still too many, the ones which were used the longest time ago
+        :return: None
+        """
+        if self.ttl is not None:
+            self.connection.execute('DELETE FROM geocodes WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self.connection.execute('DELETE FROM geocodes WHERE address IN (SELECT address FROM geocodes '
+                                    'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def get_failure(self, address):
+        """
+        :param address: address which was geocoded
+        :return: the error of the last failure if the address should not be retried yet, None otherwise
+        """
+        row = self.connection.execute('SELECT error, retry_after FROM failures WHERE address = ?',
+                                      (address,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def put_failure(self, address, error):
+        """
+        Store a failed lookup, the time until it is retried doubles with every failure of the same address
+        :param address: address which could not be geocoded
+        :param error: short description of the failure
+        :return: None
+        """
+        now = time.time()
+        row = self.connection.execute('SELECT attempts FROM failures WHERE address = ?', (address,)).fetchone()
+        attempts = 1 if row is None else row[0] + 1
+        backoff = min(self.failure_backoff * 2 ** (attempts - 1), self.max_failure_backoff)
+        self.connection.execute('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?)',
+                                (address, error, attempts, now, now + backoff))
+        self.operation()
+
+    def close(self):
+        """
+        Commit the remaining changes and close the connection to the SQLite file
+        :return: None
+        """
+        self.commit()
+        self.connection.close()
+
+
+class TokenBucket():
+    """
+        Thread safe token bucket rate limiter: tokens are refilled at a constant rate up to the capacity and every
+        request has to take one, so bursts up to the capacity are allowed but the average rate is bounded.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: number of tokens added per second
+        :param capacity: maximal number of tokens, by default one second worth of tokens (at least one)
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, waiting until one is available
+        :return: None
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BingBackend():
+    """
+        Geocoding backend using the Bing API through the geocoder package
+    """
+
+    def __init__(self, key="Not public"):
+        self.key = key
+
+    def geocode(self, address):
+        """
+        :param address: address to geocode
+        :return: [lat, lng] or None if the address was not found, raises GeocodingUnavailable if the query timed out,
+        was rate limited or failed on the server and GeocodingError for any other error
+        """
+        result = geocoder.bing(address, key=self.key)
+        # geocoder catches the errors of requests and only keeps them in error and status_code
+        if result.error:
+            status_code = result.status_code if isinstance(result.status_code, int) else None
+            raise_for_status_code(status_code, str(result.error))
+        if not result.ok:
+            return None
+        return result.latlng
+
+
+class HttpBackend():
+    """
+        Geocoding backend for a simple HTTP service, for example a local stub server in tests. The service is queried
+        with GET <url>?address=<address> and answers with a JSON object {"lat": ..., "lng": ...}, or an empty object
+        if the address was not found.
+    """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def geocode(self, address):
+        """
+        :param address: address to geocode
+        :return: [lat, lng] or None if the address was not found, raises ReadTimeout, ConnectionError or
+        GeocodingUnavailable if the query can be retried and GeocodingError for any other error
+        """
+        response = requests.get(self.url, params={'address': address}, timeout=self.timeout)
+        if response.status_code != 200:
+            raise_for_status_code(response.status_code, 'Status code ' + str(response.status_code) + ' for ' + address)
+        try:
+            result = response.json()
+        except ValueError:
+            raise GeocodingError('Invalid answer for ' + address)
+        if 'lat' not in result or 'lng' not in result:
+            return None
+        return [result['lat'], result['lng']]
+
+
+class PostalCodeGazetteer():
+    """
+        Offline geocoder for postal codes and localities, loaded into memory from a GeoNames postal code dump (the
+        tab separated CH.txt from download.geonames.org/export/zip). The coordinates are the centroids of the
+        localities, precise enough wherever only the region of a hotel matters. It can be used as a backend of the
+        GeocodingEngine, addresses are then located by the first known postal code they contain.
+    """
+    COLUMNS = ['country', 'code', 'place', 'admin_name1', 'admin_code1', 'admin_name2', 'admin_code2', 'admin_name3',
+               'admin_code3', 'lat', 'lng', 'accuracy']
+
+    def __init__(self, filename):
+        """
+        :param filename: path to the GeoNames postal code file
+        """
+        places = pd.read_csv(filename, sep='\t', header=None, names=self.COLUMNS, dtype={'code': str},
+                             encoding='utf-8')
+        places = places[places['lat'].notnull() & places['lng'].notnull()]
+        # A code or place can have several entries, take the centroid of all of them
+        codes = places.groupby(places['code'].apply(self.code_key))[['lat', 'lng']].mean()
+        self.code_to_coordinates = dict((code, [lat, lng]) for code, lat, lng in
+                                        zip(codes.index, codes['lat'], codes['lng']))
+        cities = places.groupby(places['place'].apply(self.city_key))[['lat', 'lng']].mean()
+        self.city_to_coordinates = dict((city, [lat, lng]) for city, lat, lng in
+                                        zip(cities.index, cities['lat'], cities['lng']))
+
+    def code_key(self, code):
+        """
+        :param code: postal code as number or string
+        :return: the code as string without decimals, None if it is missing
+        """
+        if pd.isnull(code) or str(code).strip() == '':
+            return None
+        try:
+            return str(int(float(code)))
+        except ValueError:
+            return str(code).strip()
+
+    def city_key(self, city):
+        """
+        :param city: name of a locality
+        :return: the lower case name, None if it is missing
+        """
+        if pd.isnull(city) or str(city).strip() == '':
+            return None
+        return str(city).strip().lower()
+
+    def locate(self, code=None, city=None):
+        """
+        :param code: postal code of the place
+        :param city: name of the locality, only used if the code is unknown
+        :return: [lat, lng] of the postal code or locality, None if neither is known
+        """
+        geolocation = self.code_to_coordinates.get(self.code_key(code))
+        if geolocation is None:
+            geolocation = self.city_to_coordinates.get(self.city_key(city))
+        return geolocation
+
+    def geocode(self, address):
+        """
+        :param address: address containing a four digit postal code
+        :return: [lat, lng] of the first known postal code in the address, None if there is none
+        """
+        for code in re.findall(r'\b\d{4}\b', address):
+            if code in self.code_to_coordinates:
+                return self.code_to_coordinates[code]
+        return None
+
+
+class GeocodingEngine():
+    """
+        Geocodes whole columns of addresses: every distinct address is resolved once, addresses in the cache are not
+        queried and the remaining ones are queried concurrently by a pool of threads. A token bucket keeps the queries
+        below the rate allowed by the provider, timeouts are retried with exponential backoff.
+    """
+
+    def __init__(self, backend, cache=None, workers=8, rate=5.0, burst=None, retries=3, backoff=1.0):
+        """
+        :param backend: object with a method geocode(address), e.g. BingBackend or HttpBackend
+        :param cache: GeocodeCache used before querying the backend, None to always query it
+        :param workers: number of queries running at the same time
+        :param rate: maximal number of queries per second
+        :param burst: maximal number of queries sent at once after a pause, by default one second worth of queries
+        :param retries: number of times a query is retried after a timeout
+        :param backoff: time in seconds to wait before the first retry, doubled for every further retry
+        """
+        self.backend = backend
+        self.cache = cache
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+
+    def query(self, address):
+        """
+        Query the backend for one address, retrying on timeouts, rate limits and server errors
+        :param address: address to geocode
+        :return: tuple of ([lat, lng] or None, error or None), error is 'not found', 'timeout' or 'error'
+        """
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                geolocation = self.backend.geocode(address)
+                return geolocation, None if geolocation is not None else 'not found'
+            except (ReadTimeout, ConnectionError, GeocodingUnavailable):
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+            except GeocodingError as error:
+                print('Geocoding error for ' + address + ': ' + str(error))
+                return ['', ''], 'error'
+        print('No answer for ' + address + ' after ' + str(self.retries + 1) + ' attempts')
+        return ['', ''], 'timeout'
+
+    def geocode(self, queries):
+        """
+        Geocode a collection of addresses
+        :param queries: dictionary from the key of an address in the cache to the address sent to the backend
+        :return: dictionary from every key to [lat, lng], None if it was not found or ['',''] if the query timed out
+        """
+        results = {}
+        missing = []
+        for key, address in queries.items():
+            if self.cache is not None:
+                geolocation = self.cache.get(key)
+                if geolocation is not None:
+                    results[key] = geolocation
+                    continue
+                error = self.cache.get_failure(key)
+                if error is not None:
+                    results[key] = None if error == 'not found' else ['', '']
+                    continue
+            missing.append((key, str(address)))
+        print("Geocoding " + str(len(missing)) + " addresses, " + str(len(results)) + " taken from the cache")
+        if len(missing) == 0:
+            if self.cache is not None:
+                self.cache.commit()
+            return results
+        pool = ThreadPool(self.workers)
+        try:
+            queried = pool.map(self.query, [address for _, address in missing], 1)
+        finally:
+            pool.close()
+            pool.join()
+        # The cache is only written from this thread
+        for (key, _), (geolocation, error) in zip(missing, queried):
+            results[key] = geolocation
+            if self.cache is not None:
+                if error is None:
+                    self.cache.put(key, geolocation)
+                else:
+                    self.cache.put_failure(key, error)
+            self.cache.commit()
+        return results
@@ -10,15 +10,22 @@
 
 
 from DatabasePandas import Database
-from scrapy.crawler import CrawlerProcess
+from scrapy.crawler import CrawlerProcess, CrawlerRunner, Crawler
+from scrapy.utils.log import configure_logging
+from scrapy.settings import Settings
+from twisted.internet import defer
 from TripAdvisorSpider import TripAdvisorSpider
 from BookingSpider import BookingSpider
 from SwissHotelSpider import SwissHotelSpider
+from pipelines import read_results, results_filename, completed_ids, remove_results
 from DatabasePandas import Matching
+from DatabasePandas import Candidates
+from Geolocation import GeocodeCache, GeocodingEngine, BingBackend, PostalCodeGazetteer
 import pandas as pd
 
 # Set the google API key for geolocation queries, key needs to be set before the import of geocoder!
 import os
+import shutil
 
 import geocoder
 # Necessary to read and write non-standard characters
@@ -52,6 +59,7 @@ INPUT_REVENUE_DETAILS = 'prediction/PredValDet.csv'
 INPUT_ECONOMIC_DATA = 'economic/economic_data.csv'
 INPUT_ECONOMIC_DATA_COORDINATES = 'coordinates/economic_data_coordinates.csv'
 INPUT_MATCHING_HOTEL_ECONOMIC = 'matching/hotels_economic.csv'
+INPUT_POSTALCODE_GAZETTEER = 'coordinates/CH.txt' # GeoNames postal codes, from download.geonames.org/export/zip
 INPUT_HOTELS = [INPUT_HOTELS_DATA, INPUT_BOOKING_DATA, INPUT_TRIPADVISOR_DATA, INPUT_TRIPADVISOR_REVIEWS_YEARLY, INPUT_HOTELS_COORDINATES]
 # Output files
 OUTPUT_HOTELS = "fullRun/hotels_full.csv" # All the hotel data in one file
@@ -68,6 +76,7 @@ OUTPUT_TRIPADVISOR_HOTELS_PRECRAWL = 'H:/homepage/tripadvisor/hotels.html'
 OUTPUT_HOTELS_SCRAPING_ERRORS = 'fullRun/errors.csv'
 OUTPUT_HOTELS_DISCREPANCIES = 'fullRun/discrepancies.csv'
 OUTPUT_MATCHING_FUZZY_TEST = 'matching/matching_fuzzy_test.csv'
+OUTPUT_MATCHING_ALGORITHMS_TEST = 'matching/matching_algorithms_test.csv'
 OUTPUT_MATCHING_FUZZY_FULL = 'matching/matching_fuzzy_full.csv'
 OUTPUT_MATCHING_UID = 'uids/uid_matching.csv'
 OUTPUT_TRIPADVISOR_DATA = 'fullRun/output_ta_full.csv'
@@ -90,6 +99,18 @@ OUTPUT_ECONOMIC_DATA_COORDINATES = 'coordinates/economic_data_coordinates.csv'
 OUTPUT_MATCHING_HOTEL_ECONOMIC = 'matching/hotels_economic.csv'
 OUTPUT_MATCHING_TRIPADVISOR_SWISSHOTELS = 'matching/tripadvisor_swisshotels.csv'
 OUTPUT_MATCHING_TRIPADVISOR_ECONOMIC_DATA = 'matching/tripadvisor_economic.csv'
+# Caches which are kept between runs
+CACHE_FUZZY_STRINGS = 'cache/fuzzy_strings.pkl' # Normalized fuzzy fields used for matching
+CACHE_MATCHING_HOTELS = 'cache/matching_hotels.pkl' # Matches between hotels and swisshotels, by tempid
+CACHE_MATCHING_TRIPADVISOR = 'cache/matching_tripadvisor.pkl' # Matches between tripadvisor and swisshotels, by taid
+CACHE_ECONOMIC_REGION_INDEX = 'cache/economic_region_index.pkl' # Code, city and coordinate index of economic regions
+CACHE_GEOCODES = 'cache/geocodes.sqlite' # Results of the geolocation queries
+GEOCODE_TTL = 180*24*3600 # Seconds after which a geolocation is queried again
+GEOCODE_CACHE_SIZE = 100000 # Maximal number of geolocations kept, the least recently used ones are removed
+GEOCODE_FAILURE_BACKOFF = 3600 # Seconds before a failed geolocation is retried, doubled after every failure
+GEOCODING_WORKERS = 8 # Number of geolocation queries running at the same time
+GEOCODING_RATE = 5.0 # Maximal number of geolocation queries per second allowed by the provider
+GEOCODING_RETRIES = 3 # Number of retries after a timeout, with exponential backoff
 # HTML Code
 PREFIX_GOOGLE_CRAWL = "<!DOCTYPE html><html><body><h2>A list of Google querys to scrape</h2><ul>"
 PREFIX_SWISSHOTELS_CRAWL = "<!DOCTYPE html><html><body><h2>A list of Swisshotel overviews to scrape</h2><ul>"
@@ -100,21 +121,44 @@ POSTFIX = "</ul></body></html>"
 TEST_MODE = False # When activated only a limited number of websites will get crawled
 TEST_LIMIT = 100 # How many websites will be crawled in test mode
 RANDOMIZE_TEST = True # Should the test sample be randomized?
+RESULTS_DIRECTORY = 'results' # The spiders write their items to <name>.jsonl.gz in this directory while crawling
+RESULTS_BATCH_SIZE = 100 # Number of items written to the results file at once
+JOBS_DIRECTORY = 'jobs' # Scrapy keeps the state of resumable crawls in <name> of this directory (JOBDIR)
+RESUME_CRAWLS = False # Continue the previous crawl where it stopped instead of starting from the first URL
+CONCURRENT_CRAWLS = True # Run the spiders of a CrawlOrchestrator at the same time instead of one after another
+HTTP_CACHE_REVALIDATE = 'revalidate' # Pages are revalidated with the server, unchanged pages are not parsed again
+HTTP_CACHE_OFFLINE = 'offline' # Pages are only replayed from the cache, pages which are not cached are skipped
+HTTP_CACHE_MODE = None # None, HTTP_CACHE_REVALIDATE or HTTP_CACHE_OFFLINE
+HTTP_CACHE_DIRECTORY = 'httpcache' # Cached responses, relative to the .scrapy directory of the project
 MINIMUM_AVAILABLE_VALUES = 3
+MATCHING_WORKERS = 1 # Number of processes used for the fuzzy matching, 1 does the matching in the main process
+MATCHING_CHUNK_SIZE = 100 # Number of hotels handed to a matching process at once
+MATCHING_STREAM_SIZE = 2000 # Number of tripadvisor hotels matched before their results are written to the output
+ECONOMIC_MATCHING_HAVERSINE = False # Closest economic region by great-circle instead of coordinate distance
+MATCHING_CANDIDATES = Candidates.POSTALCODE # How the candidate swisshotels are chosen for each hotel
+MATCHING_GRID = [Candidates.GRID, Candidates.POSTALCODE_GRID] # Candidate generations which need the coordinates
+MATCHING_EARLY_REJECTION = True # Skip full comparisons which cannot beat the best score, the result stays the same
+MATCHING_CUTOFF = None # Minimum score of a match in the full matching, None to keep all the matches
+MATCHING_AUTOMATIC_CUTOFF = False # Without MATCHING_CUTOFF, use the best cutoff of the validation on the test sample
 
 
-def kwargs_dict_from_urls(urls):
+def kwargs_dict_from_urls(urls, completed=None):
     """
     Take a list of (id,url) pairs and create a list of urls and a dictionary from url to id.
     :param urls: list of (id, url) pairs
+    :param completed: set of ids which were already scraped by a previous run, their urls are left out
     :return: dictionary which will be set as kwargs parameter, the name of the dictionary is the name of the
                 attribute, the value will be the value of the attribute
     """
     start_urls = []
     url_to_id = {}
     for id, url in urls:
+        if completed and id in completed:
+            continue
         start_urls.append(url)
         url_to_id[url] = id
+    if completed:
+        print("Skipping " + str(len(urls) - len(start_urls)) + " urls scraped by a previous run")
     return {"url_to_id": url_to_id, "start_urls" : start_urls}
 
 
@@ -262,155 +306,416 @@ def collect_google_data(database, hotel_path, swisshotel_path):
     database.collect_google_data_from_csv(hotel_path, swisshotel_path)
 
 
-def add_booking_spider(process, urls):
-    """
-    Retrieves the data for the Booking spider from the database and adds it to the spider. A dictionary
-    containing the results is created and shared with the spider. It will be used to store the data retrieved
-    from the crawl
+def http_cache_settings(cache_mode):
+    """
+    Settings of the persistent HTTP cache. In the revalidate mode the responses are stored with their ETag and
+    Last-Modified headers and the next crawl sends conditional requests, pages which did not change come from the
+    cache and are not parsed again if their item is already stored. The offline mode replays the cache without any
+    request to the websites.
+    :param cache_mode: None for no cache, HTTP_CACHE_REVALIDATE or HTTP_CACHE_OFFLINE
+    :return: dictionary of settings for CrawlerProcess
+    """
+    if cache_mode is None:
+        return {}
+    settings = {
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_DIR': HTTP_CACHE_DIRECTORY,
+        'HTTPCACHE_STORAGE': 'scrapy.extensions.httpcache.FilesystemCacheStorage',
+    }
+    if cache_mode == HTTP_CACHE_REVALIDATE:
+        settings['HTTPCACHE_POLICY'] = 'middlewares.RevalidatingPolicy'
+        # Also store pages sent with no-cache, they are revalidated instead of downloaded again
+        settings['HTTPCACHE_ALWAYS_STORE'] = True
+        settings['DOWNLOADER_MIDDLEWARES'] = {'middlewares.SkipUnchangedMiddleware': 890}
+    elif cache_mode == HTTP_CACHE_OFFLINE:
+        settings['HTTPCACHE_POLICY'] = 'scrapy.extensions.httpcache.DummyPolicy'
+        settings['HTTPCACHE_IGNORE_MISSING'] = True
+    else:
+        raise ValueError('Unrecognized HTTP cache mode')
+    return settings
+
+
+def crawler_settings(settings=None, job=None, resume=False, cache_mode=None):
+    """
+    Settings of a crawler process, the spiders hand their items to the pipeline which writes them to the results files
+    and the adaptive throttle sets the request rate of every domain, tuned by the custom_settings of the spiders
+    :param settings: additional settings of the process
+    :param job: name of the job directory in which scrapy keeps the state of the crawl, None for a crawl which can not
+    be resumed. Only one spider of the process can use it
+    :param resume: continue from the state of the previous crawl, otherwise it is removed
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
+    :return: dictionary of settings for CrawlerProcess
+    """
+    crawler_settings = {
+        'ITEM_PIPELINES': {'pipelines.JsonLinesPipeline': 300},
+        'RESULTS_DIRECTORY': RESULTS_DIRECTORY,
+        'RESULTS_BATCH_SIZE': RESULTS_BATCH_SIZE,
+        'EXTENSIONS': {'throttle.AdaptiveThrottle': 0},
+    }
+    crawler_settings.update(http_cache_settings(cache_mode))
+    if job is not None:
+        job_directory = os.path.join(JOBS_DIRECTORY, job)
+        if not resume and os.path.exists(job_directory):
+            shutil.rmtree(job_directory)
+        crawler_settings['JOBDIR'] = job_directory
+    if settings is not None:
+        crawler_settings.update(settings)
+    return crawler_settings
+
+
+def create_results_file(name, resume=False):
+    """
+    Start a new results file for a spider, the results of a previous crawl are removed unless it is resumed
+    :param name: name of the spider
+    :param resume: keep the results of the previous crawl and append to them
+    :return: path of the results file
+    """
+    results_file = results_filename(RESULTS_DIRECTORY, name)
+    if not resume:
+        remove_results(results_file)
+    return results_file
+
+
+def add_results_file(kwargs, name, resume=False, cache_mode=None):
+    """
+    Set the results file of a spider. When the HTTP cache revalidates the pages the results of the previous crawl are
+    kept, the urls whose item is stored are given to the spider so their unchanged pages are skipped
+    :param kwargs: keyword arguments of the spider, with the start_urls and the url_to_id if the ids are not the urls
+    :param name: name of the spider
+    :param resume: if the previous crawl is resumed
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
+    :return: path of the results file
+    """
+    revalidate = cache_mode == HTTP_CACHE_REVALIDATE
+    kwargs["results_file"] = create_results_file(name, resume or revalidate)
+    if revalidate:
+        stored = completed_ids(kwargs["results_file"])
+        if "url_to_id" in kwargs:
+            kwargs["stored_urls"] = set(url for url, id in kwargs["url_to_id"].items() if id in stored)
+        else:
+            kwargs["stored_urls"] = set(url for url in kwargs["start_urls"] if url in stored)
+    return kwargs["results_file"]
+
+
+def completed_crawl_ids(name, resume):
+    """
+    :param name: name of the spider
+    :param resume: if the previous crawl is resumed
+    :return: set of the ids in the results file of the previous crawl, empty if it is not resumed
+    """
+    # The results file is the only record of what was scraped. The start urls of the spiders are not checked against
+    # the duplicate filter of the job directory, which also holds the urls of requests lost in a crash
+    if not resume:
+        return set()
+    completed = completed_ids(results_filename(RESULTS_DIRECTORY, name))
+    print("Resuming the crawl " + name + " after " + str(len(completed)) + " scraped hotels")
+    return completed
+
+
+def add_booking_spider(process, urls, resume=False, cache_mode=None):
+    """
+    Retrieves the data for the Booking spider from the database and adds it to the spider. The spider writes the data
+    retrieved from the crawl to its results file while crawling
     :param process: A scrapy process which will handle the spider
     :param database: Database which contains the URLs to be scraped from the Booking.com website
-    :return: A dictionary in which the data from the crawl will be stored, indexed by ID
+    :param resume: leave out the urls in the results file of the previous crawl and append to it
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
+    :return: The path of the results file, read it with read_results once the crawl is finished
     """
-    kwargs = kwargs_dict_from_urls(urls)
-    results = {}
-    kwargs["results"] = results
+    kwargs = kwargs_dict_from_urls(urls, completed_crawl_ids(BookingSpider.name, resume))
+    add_results_file(kwargs, BookingSpider.name, resume, cache_mode)
     process.crawl(BookingSpider(), **kwargs)
-    return results
+    return kwargs["results_file"]
 
 
-def add_tripadvisor_spider(process, urls):
+def add_tripadvisor_spider(process, urls, resume=False, cache_mode=None):
     """
-    Retrieves the data for the Tripadvisor spider from the database and adds it to the spider. A dictionary
-    containing the results is created and shared with the spider. It will be used to store the data retrieved
-    from the crawl
+    Retrieves the data for the Tripadvisor spider from the database and adds it to the spider. The spider writes the
+    data retrieved from the crawl to its results file while crawling
     :param process: A scrapy process which will handle the spider
     :param database: Database which contains the URLs to be scraped from the Tripadvisor website
-    :return: A dictionary in which the data from the crawl will be stored, indexed by ID
+    :param resume: leave out the urls in the results file of the previous crawl and append to it
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
+    :return: The path of the results file, read it with read_results once the crawl is finished
     """
-    kwargs = kwargs_dict_from_urls(urls)
-    results = {}
-    kwargs["results"] = results
+    kwargs = kwargs_dict_from_urls(urls, completed_crawl_ids(TripAdvisorSpider.name, resume))
+    add_results_file(kwargs, TripAdvisorSpider.name, resume, cache_mode)
     kwargs["use_url_as_id"] = False
     process.crawl(TripAdvisorSpider(), **kwargs)
-    return results
+    return kwargs["results_file"]
 
 
-def add_swisshotel_spider(process, urls):
+def add_swisshotel_spider(process, urls, resume=False, cache_mode=None):
     """
     Retrieves the swisshotel URLs to be scraped from the database and creates a spider which crawls the swisshotel
-    website. A dictionary containing the results is created and shared with the spider.
-    It will be used to store the data retrieved
-    from the crawl
+    website. The spider writes the data retrieved from the crawl to its results file while crawling
     :param process: A scrapy process which will handle the spider
     :param database: Database which contains the URLs to be scraped from the swisshotels website
-    :return: A dictionary in which the data from the crawl will be stored, indexed by ID
+    :param resume: leave out the urls in the results file of the previous crawl and append to it
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
+    :return: The path of the results file, read it with read_results once the crawl is finished
     """
-    kwargs = kwargs_dict_from_urls(urls)
-    results = {}
-    kwargs["results"] = results
+    kwargs = kwargs_dict_from_urls(urls, completed_crawl_ids(SwissHotelSpider.name, resume))
+    add_results_file(kwargs, SwissHotelSpider.name, resume, cache_mode)
     process.crawl(SwissHotelSpider(), **kwargs)
-    return results
-
-
-def collect_tripadvisor_data(database, output_tripadvisor='fullRun/tripadvisor_crawl.csv'):
+    return kwargs["results_file"]
+
+
+class CrawlOrchestrator():
+    """
+        Runs any number of spiders in one reactor of a CrawlerRunner, either all at the same time or one after another,
+        and stores the results of every spider in the database as soon as its crawl is finished. Every spider has its
+        own settings and job directory, so all of them can be resumed. The reactor of Twisted can not be restarted,
+        run can only be called once in a session of the program.
+        Queue the spiders with add, e.g. orchestrator.add(add_booking_spider, urls, store), the orchestrator takes the
+        place of the process in the add_*_spider functions.
+    """
+
+    def __init__(self, concurrent=CONCURRENT_CRAWLS, resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
+        """
+        :param concurrent: run all the spiders at the same time, otherwise in the order they were added
+        :param resume: continue the previous crawls where they stopped
+        :param cache_mode: mode of the HTTP cache, see http_cache_settings
+        """
+        self.concurrent = concurrent
+        self.resume = resume
+        self.cache_mode = cache_mode
+        self.crawls = []
+
+    def crawl(self, spider, **kwargs):
+        """
+        Same signature as CrawlerProcess.crawl, called by the add_*_spider functions
+        :param spider: spider class or instance
+        :param kwargs: keyword arguments of the spider
+        :return: None
+        """
+        spider_class = spider if isinstance(spider, type) else type(spider)
+        self.crawls.append({'spider': spider_class, 'kwargs': kwargs, 'job': spider_class.name, 'settings': None,
+                            'store': None})
+
+    def add(self, add_spider, urls, store, settings=None):
+        """
+        Queue a spider
+        :param add_spider: function which adds the spider, e.g. add_booking_spider
+        :param urls: list of (id, url) pairs to crawl
+        :param store: function called with the results of the spider once its crawl is finished
+        :param settings: additional settings of the spider
+        :return: path of the results file
+        """
+        results_file = add_spider(self, urls, self.resume, self.cache_mode)
+        crawl = self.crawls[-1]
+        crawl['results_file'] = results_file
+        crawl['store'] = store
+        crawl['settings'] = settings
+        return results_file
+
+    def start(self, runner, crawl):
+        """
+        Start the crawl of one spider, its results are stored when it is finished
+        :return: Deferred which fires once the results are stored
+        """
+        crawler = Crawler(crawl['spider'], crawler_settings(crawl['settings'], crawl['job'], self.resume,
+                                                            self.cache_mode))
+        print("Starting the crawl for " + crawl['job'])
+        deferred = runner.crawl(crawler, **crawl['kwargs'])
+        # A failed crawl is not stored, an error while storing is reported on its own
+        deferred.addCallbacks(self.store, self.failed, callbackArgs=(crawl,), errbackArgs=(crawl,))
+        deferred.addErrback(self.store_failed, crawl)
+        return deferred
+
+    def store(self, _, crawl):
+        print("Finished the crawl for " + crawl['job'])
+        if crawl['store'] is not None:
+            crawl['store'](read_results(crawl['results_file']))
+
+    def failed(self, failure, crawl):
+        # The other spiders keep running, the results written so far stay in the results file
+        print("The crawl for " + crawl['job'] + " failed: " + failure.getErrorMessage())
+
+    def store_failed(self, failure, crawl):
+        print("Storing the results of the crawl for " + crawl['job'] + " failed: " + failure.getTraceback())
+
+    def install_reactor(self):
+        """
+        Install the reactor the crawlers expect (TWISTED_REACTOR, the asyncio reactor since Scrapy 2.7). Unlike
+        CrawlerProcess, a CrawlerRunner does not install it and the crawls never start in a different reactor.
+        :return: None
+        """
+        try:
+            from scrapy.utils.reactor import install_reactor
+        except ImportError:
+            # Scrapy before 2.0 only runs in the default reactor
+            return
+        reactor_class = Settings(crawler_settings()).get('TWISTED_REACTOR')
+        if reactor_class and 'twisted.internet.reactor' not in sys.modules:
+            install_reactor(reactor_class)
+
+    @defer.inlineCallbacks
+    def run_sequentially(self, runner):
+        for crawl in self.crawls:
+            yield self.start(runner, crawl)
+
+    def run(self):
+        """
+        Run all the queued spiders, the script will block here until all the crawls are finished
+        :return: None
+        """
+        self.install_reactor()
+        # Imported here, the import installs the default reactor
+        from twisted.internet import reactor
+        configure_logging()
+        runner = CrawlerRunner()
+        if self.concurrent:
+            finished = defer.DeferredList([self.start(runner, crawl) for crawl in self.crawls])
+        else:
+            finished = self.run_sequentially(runner)
+        finished.addBoth(lambda _: reactor.stop())
+        reactor.run()
+
+
+def collect_tripadvisor_data(database, output_tripadvisor='fullRun/tripadvisor_crawl.csv', resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
     """
     Creates and starts a process which will handle the crawl, once the crawl is finished the results will be stored
     in the database
     :param database: database which is able to retrieve the tripadivsor urls and store the results of the crawl
+    :param resume: continue the previous crawl where it stopped
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
     :return: None
     """
-    process = CrawlerProcess({
+    process = CrawlerProcess(crawler_settings({
         'USER_AGENT': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)'
-    })
-    results = add_tripadvisor_spider(process, database.get_tripadvisor_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST))
+    }, TripAdvisorSpider.name, resume, cache_mode))
+    results_file = add_tripadvisor_spider(process, database.get_tripadvisor_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                                          resume, cache_mode)
     print("Starting the crawl for tripadvisor")
     process.start()  # the script will block here until the crawling is finished
     print("Finished the crawl for tripadvisor")
-    database.store_scraping_results(results, True)
+    database.store_scraping_results(read_results(results_file), True)
 
 
-def collect_tripadvisor_all_hotel_data(database, tripadvisor_urls_input=INPUT_TRIPADVISOR_ALL_HOTELS):
+def collect_tripadvisor_all_hotel_data(database, tripadvisor_urls_input=INPUT_TRIPADVISOR_ALL_HOTELS, resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
     """
 
     :param database:
+    :param resume: continue the previous crawl where it stopped
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
     :return:
     """
-    process = CrawlerProcess({
+    name = TripAdvisorSpider.name + '_all_hotels'
+    process = CrawlerProcess(crawler_settings({
         'USER_AGENT': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)'
-    })
-    start_urls = database.get_all_tripadvisor_urls(tripadvisor_urls_input, TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST)
+    }, name, resume, cache_mode))
+    start_urls = database.get_all_tripadvisor_urls(tripadvisor_urls_input, TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST,
+                                                   completed_crawl_ids(name, resume))
     kwargs = {"start_urls" : start_urls}
-    results = {}
-    kwargs["results"] = results
+    add_results_file(kwargs, name, resume, cache_mode)
     kwargs["use_url_as_id"] = True
     process.crawl(TripAdvisorSpider(), **kwargs)
     print("Starting the crawl for tripadvisor")
     process.start()  # the script will block here until the crawling is finished
     print("Finished the crawl for tripadvisor")
-    database.store_scraping_results(results, True, True)
+    database.store_scraping_results(read_results(kwargs["results_file"]), True, True)
 
 
-def collect_booking_data(database):
+def collect_booking_data(database, resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
     """
     Creates and starts a process which will handle the crawl, once the crawl is finished the results will be stored
     in the database
     :param database: database which is able to retrieve the booking.com urls and store the results of the crawl
+    :param resume: continue the previous crawl where it stopped
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
     :return: None
     """
-    process = CrawlerProcess({})
-    results = add_booking_spider(process, database.get_booking_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST))
+    process = CrawlerProcess(crawler_settings(None, BookingSpider.name, resume, cache_mode))
+    results_file = add_booking_spider(process, database.get_booking_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST), resume,
+                                      cache_mode)
     print("Starting the crawl for booking")
     process.start()  # the script will block here until the crawling is finished
     print("Finished the crawl for booking")
-    database.store_scraping_results(results, True)
+    database.store_scraping_results(read_results(results_file), True)
 
 
-def collect_swisshotel_database(database):
+def collect_swisshotel_database(database, resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
     """
     Creates and starts a process which will handle the crawl, once the crawl is finished the results will be stored
     in the database
     :param database: database which is able to retrieve the swisshotels urls and store the results of the crawl
+    :param resume: continue the previous crawl where it stopped
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
     :return: None
     """
-    process = CrawlerProcess({})
-    results = add_swisshotel_spider(process, database.get_swisshotel_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST))
+    process = CrawlerProcess(crawler_settings(None, SwissHotelSpider.name, resume, cache_mode))
+    results_file = add_swisshotel_spider(process, database.get_swisshotel_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                                         resume, cache_mode)
     print("Starting the crawl for swisshotel")
     process.start()  # the script will block here until the crawling is finished
     print("Finished the crawl for swisshotel")
-    database.store_scraping_results(results, False)
+    database.store_scraping_results(read_results(results_file), False)
 
 
 
 
-def collect_tripadvisor_booking_data(database):
+def collect_tripadvisor_booking_data(database, resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
     """
-    Creates and starts a process which will handle the crawl, once the crawl is finished the results will be stored
-    in the database. The two crawls of tripadvisor and booking will run in parallel, both will store their results
-    in different dictionaries in order not to overwrite each others results. The crawl has to be this way as it
-    is not possible to run multiple processes easily in one session of the program.
+    Crawl tripadvisor and booking in one process, the two crawls run in parallel and store their results in the
+    database as soon as each of them is finished
     :param database: database which is able to retrieve the tripadivsor/booking urls and store the results of the crawl
+    :param resume: continue the previous crawls where they stopped
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
     :return: None
     """
-    process = CrawlerProcess({})
-    results_t = add_tripadvisor_spider(process, database.get_tripadvisor_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST))
-    results_b = add_booking_spider(process, database.get_booking_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST))
-    print("Starting the crawl for tripadvisor and booking")
-    process.start()  # the script will block here until the crawling is finished
-    print("Finished the crawl for tripadvisor and booking")
-    database.store_scraping_results(results_t, True)
-    database.store_scraping_results(results_b, True)
+    orchestrator = CrawlOrchestrator(True, resume, cache_mode)
+    orchestrator.add(add_tripadvisor_spider, database.get_tripadvisor_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                     lambda results: database.store_scraping_results(results, True))
+    orchestrator.add(add_booking_spider, database.get_booking_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                     lambda results: database.store_scraping_results(results, True))
+    orchestrator.run()
+
+
+def collect_all_data(database, concurrent=CONCURRENT_CRAWLS, resume=RESUME_CRAWLS, cache_mode=HTTP_CACHE_MODE):
+    """
+    Full refresh of the crawled data in one process: booking, tripadvisor and swisshotel are crawled in one reactor
+    and the results of every spider are stored in the database as soon as its crawl is finished
+    :param database: database which is able to retrieve the urls and store the results of the crawls
+    :param concurrent: run the three crawls at the same time, otherwise one after another
+    :param resume: continue the previous crawls where they stopped
+    :param cache_mode: mode of the HTTP cache, see http_cache_settings
+    :return: None
+    """
+    orchestrator = CrawlOrchestrator(concurrent, resume, cache_mode)
+    orchestrator.add(add_booking_spider, database.get_booking_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                     lambda results: database.store_scraping_results(results, True))
+    orchestrator.add(add_tripadvisor_spider, database.get_tripadvisor_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                     lambda results: database.store_scraping_results(results, True),
+                     {'USER_AGENT': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)'})
+    orchestrator.add(add_swisshotel_spider, database.get_swisshotel_urls(TEST_MODE, TEST_LIMIT, RANDOMIZE_TEST),
+                     lambda results: database.store_scraping_results(results, False))
+    orchestrator.run()
 
 
-def construct_database(hotels_csv=INPUT_HOTELS, swisshotels_csv=INPUT_SWISSHOTELS_FULL, economic_data=INPUT_ECONOMIC_DATA):
+def construct_database(hotels_csv=INPUT_HOTELS, swisshotels_csv=INPUT_SWISSHOTELS_FULL, economic_data=INPUT_ECONOMIC_DATA, fuzzy_cache=CACHE_FUZZY_STRINGS, geocode_cache=CACHE_GEOCODES, gazetteer=INPUT_POSTALCODE_GAZETTEER):
     """
     Create the database object which will be vital to process and store all the information we retrieve online.
     Usually the results of the crawls from booking and tripadvisor are stored in separate CSVs in order to handle
     them easier. All of that data will be merged inside the database.
     :param hotels_csv: List containing all the CSVs which belong into the same hotel database
     :param swisshotels_csv: The path to the swisshotel CSV file, if its none we wont load swisshotel data
+    :param fuzzy_cache: Path to the cache of the fuzzy strings used for matching, None disables the cache
+    :param geocode_cache: Path to the cache of the geolocation queries, None disables the cache
+    :param gazetteer: Path to the GeoNames postal codes used to locate addresses without street offline, None or a
+    missing file disables it
     :return: the database object to access and store data related to hotels
     """
     database = Database()
+    database.fuzzy_cache_file = fuzzy_cache
+    if geocode_cache is not None:
+        database.geocode_cache = GeocodeCache(geocode_cache, GEOCODE_TTL, GEOCODE_CACHE_SIZE, GEOCODE_FAILURE_BACKOFF)
+    database.geocoding_engine = GeocodingEngine(BingBackend(), database.geocode_cache, GEOCODING_WORKERS,
+                                                GEOCODING_RATE, retries=GEOCODING_RETRIES)
+    if gazetteer is not None and os.path.exists(gazetteer):
+        database.gazetteer = PostalCodeGazetteer(gazetteer)
+    elif gazetteer is not None:
+        print("No postal code gazetteer under " + gazetteer + ", all addresses will be geocoded online")
     print("Loading the hotel database from CSV")
     # Check if we want to load a single csv or a many
     if 'str' in str(type(hotels_csv)):
@@ -493,35 +798,73 @@ def pre_matching_diagnostics(database, output_file=OUTPUT_HOTELS_DISCREPANCIES):
     database.compare_data_sources(output_file)
 
 
-def match_hotels_swisshotels(database, TEST_MATCHING = False):
+def match_hotels_swisshotels(database, TEST_MATCHING = False, match_store=CACHE_MATCHING_HOTELS, cutoff=MATCHING_CUTOFF, automatic_cutoff=MATCHING_AUTOMATIC_CUTOFF):
     """
     Match all the entries in the hotel dataset which have address information with the swisshotel dataset. The
     algorithm can be chosen from the matching class, however the ALL_P_NAME_P_STREET has has the best results
     so far during testing.
     :param database: Initialized database which contains both hotel and swisshotel data
     :param TEST_MATCHING: Should only a subset be tested and validated?
+    :param match_store: Store of previous matches, only hotels whose data or candidates changed are matched again
+    :param cutoff: Minimum score of a match in the full matching, None to keep all the matches
+    :param automatic_cutoff: Without a cutoff, validate the test sample first and use its best cutoff
     :return: None
     """
-    if TEST_MATCHING:
-        # Matching only a subset
-        database.create_matching_by_fuzzy(INPUT_MATCHING_TEST_SAMPLE, algorithm=Matching.ALL_P_NAME_P_STREET)
+    if MATCHING_CANDIDATES in MATCHING_GRID and 'sh_x' not in database.swisshotels.keys():
+        load_swisshotel_coordinates(database)
+    validate = TEST_MATCHING or (cutoff is None and automatic_cutoff)
+    if validate and not TEST_MATCHING and not os.path.exists(INPUT_MATCHING_TEST_SAMPLE):
+        print("The test sample " + INPUT_MATCHING_TEST_SAMPLE + " does not exist, matching without a cutoff")
+        validate = False
+    if validate:
+        # Matching only a subset, its validation gives the best cutoff for the full matching
+        database.create_matching_by_fuzzy(INPUT_MATCHING_TEST_SAMPLE, algorithm=Matching.ALL_P_NAME_P_STREET,
+                                          candidates=MATCHING_CANDIDATES, workers=MATCHING_WORKERS,
+                                          chunk_size=MATCHING_CHUNK_SIZE, early_rejection=MATCHING_EARLY_REJECTION,
+                                          match_store=match_store)
         database.validate_matching()
+        if cutoff is None:
+            cutoff = database.matching_cutoff
+    if TEST_MATCHING:
         database.store_matched_hotels_to_csv(OUTPUT_MATCHING_FUZZY_TEST)
     else:
         # Full matching
-        database.create_matching_by_fuzzy(algorithm=Matching.ALL_P_NAME_P_STREET)
+        database.create_matching_by_fuzzy(algorithm=Matching.ALL_P_NAME_P_STREET, candidates=MATCHING_CANDIDATES,
+                                          workers=MATCHING_WORKERS, chunk_size=MATCHING_CHUNK_SIZE,
+                                          early_rejection=MATCHING_EARLY_REJECTION, match_store=match_store)
+        if cutoff is not None:
+            database.apply_matching_cutoff(cutoff)
         database.store_matched_hotels_to_csv(OUTPUT_MATCHING_FUZZY_FULL)
 
-def match_tripadvisor_swisshotels(database, input_tripadvisor=OUTPUT_TRIPADVISOR_HOTELS, output_matching=OUTPUT_MATCHING_TRIPADVISOR_SWISSHOTELS):
+def compare_matching_algorithms(database, output_file=OUTPUT_MATCHING_ALGORITHMS_TEST):
+    """
+    Match the test sample with all the algorithms of the matching class in a single pass and validate each of them
+    :param database: Initialized database which contains both hotel and swisshotel data
+    :param output_file: CSV file where the matches of all the algorithms are stored side by side
+    :return: None
+    """
+    database.create_matching_all_algorithms(INPUT_MATCHING_TEST_SAMPLE, candidates=MATCHING_CANDIDATES)
+    database.validate_matching_algorithms()
+    database.matching_algorithms.to_csv(output_file, index=False, encoding='utf-8-sig')
+    print("Wrote the matching of all algorithms to " + output_file)
+
+def match_tripadvisor_swisshotels(database, input_tripadvisor=OUTPUT_TRIPADVISOR_HOTELS, output_matching=OUTPUT_MATCHING_TRIPADVISOR_SWISSHOTELS, match_store=CACHE_MATCHING_TRIPADVISOR):
     """
     Try to match the hotels from the tripadvisor crawl to the hotels from the swisshotel crawl
     :param database: database with initialized swisshotel data
     :param input_tripadvisor:
     :param input_swisshotels:
     :param output_matching:
+    :param match_store: Store of previous matches, only hotels whose data or candidates changed are matched again
     :return:
     """
-    database.create_matching_tripadvisor_hotels(input_tripadvisor, output_matching, algorithm=Matching.ALL_P_DYNAMIC)
+    if MATCHING_CANDIDATES in MATCHING_GRID and 'sh_x' not in database.swisshotels.keys():
+        load_swisshotel_coordinates(database)
+    database.create_matching_tripadvisor_hotels(input_tripadvisor, output_matching, algorithm=Matching.ALL_P_DYNAMIC,
+                                                candidates=MATCHING_CANDIDATES, workers=MATCHING_WORKERS,
+                                                chunk_size=MATCHING_CHUNK_SIZE,
+                                                early_rejection=MATCHING_EARLY_REJECTION, match_store=match_store,
+                                                stream_size=MATCHING_STREAM_SIZE)
 
 def match_tripadvisor_economic_data(databasae, input_tripadvisor=OUTPUT_TRIPADVISOR_HOTELS, output_matching=OUTPUT_MATCHING_TRIPADVISOR_ECONOMIC_DATA, economic_data_coordinates=INPUT_ECONOMIC_DATA_COORDINATES):
     """
@@ -531,7 +874,9 @@ def match_tripadvisor_economic_data(databasae, input_tripadvisor=OUTPUT_TRIPADVI
     :param output_matching:
     :return:
     """
-    databasae.create_matching_tripadvisor_economic_data(input_tripadvisor, economic_data_coordinates, output_matching)
+    databasae.create_matching_tripadvisor_economic_data(input_tripadvisor, economic_data_coordinates, output_matching,
+                                                        haversine=ECONOMIC_MATCHING_HAVERSINE,
+                                                        index_file=CACHE_ECONOMIC_REGION_INDEX)
 
 
 def create_database_for_uid_request(database, output_file=OUTPUT_MATCHING_UID):
@@ -675,7 +1020,8 @@ def match_hotels_economic_data(database, economic_data_coordinates=INPUT_ECONOMI
     :param economic_data: Path to a file containing the economic data
     :return: None
     """
-    database.match_hotels_economic_data(economic_data_coordinates)
+    database.match_hotels_economic_data(economic_data_coordinates, haversine=ECONOMIC_MATCHING_HAVERSINE,
+                                        index_file=CACHE_ECONOMIC_REGION_INDEX)
     database.store_hotel_econmic_data_matching(matching_file)
 
 def create_predicitive_files(database, output_revenue_small=OUTPUT_PREDICTION_REVENUE_SMALL, input_revenue=INPUT_PREDICTION, input_tripadvisor=OUTPUT_TRIPADVISOR_HOTELS, economic_matching=OUTPUT_MATCHING_TRIPADVISOR_ECONOMIC_DATA,swisshotel_matching=OUTPUT_MATCHING_TRIPADVISOR_SWISSHOTELS, output_price=OUTPUT_TRIPADVISOR_HOTELS_PRICE_PREDICTION,  output_rooms=OUTPUT_TRIPADVISOR_HOTELS_ROOM_PREDICTION, output_revenue_all=OUTPUT_PREDICTION_REVENUE_ALL, output_classification=OUTPUT_PREDICTION_REVENUE_CLASSIFICATION, input_revenue_classification=OUTPUT_REVENUE_CLASSIFICATION, input_yearly_ratings=OUTPUT_TRIPADVISOR_REVIEWS_YEARLY):
@@ -723,6 +1069,8 @@ def main():
     #collect_swisshotel_database(database)
     # Crawl the two sites
     #collect_tripadvisor_booking_data(database)
+    # Crawl booking, tripadvisor and swisshotel in one process
+    #collect_all_data(database)
 
     # Output the necessary file for crawling google
     #prepare_google_data_collection(database)
@@ -758,6 +1106,7 @@ def main():
 
     # Match the data
     #match_hotels_swisshotels(database)
+    #compare_matching_algorithms(database)
     #match_hotels_economic_data(database)
     #match_tripadvisor_swisshotels(database)
     #match_tripadvisor_economic_data(database)
@@ -0,0 +1,230 @@
+"""
+    Offline benchmark of the parse functions of the spiders. Recorded HTML pages of a website (fixtures) are given to
+    the spider, either directly as HtmlResponse objects or through a crawl of a local HTTP server which serves them,
+    so changes of the selectors and parsers can be compared on a machine without network.
+
+    Usage: python SpiderBenchmark.py <booking|tripadvisor|swisshotel> [fixture directory] [pages] [--server]
+    The fixtures are the .html files of the directory, by default benchmark/<spider name>, they are used again and
+    again until the number of pages is reached.
+
+"""
+
+
+from BookingSpider import BookingSpider
+from TripAdvisorSpider import TripAdvisorSpider
+from SwissHotelSpider import SwissHotelSpider
+from scrapy.crawler import CrawlerProcess
+from scrapy.http import HtmlResponse, Request
+try:
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from socketserver import ThreadingMixIn
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+import threading
+import time
+import os
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is not reported there
+    resource = None
+
+
+SPIDERS = {
+    BookingSpider.name: BookingSpider,
+    TripAdvisorSpider.name: TripAdvisorSpider,
+    SwissHotelSpider.name: SwissHotelSpider,
+}
+FIXTURE_DIRECTORY = 'benchmark' # Contains one directory of fixtures for every spider, named like the spider
+BENCHMARK_PAGES = 1000 # Number of pages parsed by default
+SERVER_PORT = 8642 # Port of the local HTTP server in the server mode
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+        Serves the files of the fixture directory, the path of the request is the name of the file
+    """
+    directory = None
+
+    def do_GET(self):
+        path = os.path.join(self.directory, os.path.basename(self.path.split('?')[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as fixture:
+            body = fixture.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def read_fixtures(directory):
+    """
+    :param directory: directory with the recorded pages
+    :return: list of (file name, content) of the .html files, sorted by name
+    """
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.html'))
+    if len(names) == 0:
+        raise ValueError('No .html fixtures in ' + directory)
+    fixtures = []
+    for name in names:
+        with open(os.path.join(directory, name), 'rb') as fixture:
+            fixtures.append((name, fixture.read()))
+    return fixtures
+
+
+def create_timed_spider(spider_class, timings):
+    """
+    Subclass of a spider which measures the time spent in parse and crawls without any delay
+    :param spider_class: class of the spider to benchmark
+    :param timings: list to which the parse time of every page is appended
+    :return: the subclass
+    """
+    custom_settings = dict(spider_class.custom_settings or {})
+    custom_settings['DOWNLOAD_DELAY'] = 0
+    custom_settings.pop('LOG_FILE', None)
+
+    class TimedSpider(spider_class):
+        def parse(self, response):
+            start = time.time()
+            items = list(spider_class.parse(self, response))
+            timings.append(time.time() - start)
+            return items
+
+    TimedSpider.name = spider_class.name
+    TimedSpider.custom_settings = custom_settings
+    return TimedSpider
+
+
+def page_urls(fixtures, pages, base_url):
+    """
+    :param fixtures: list of (file name, content)
+    :param pages: number of pages to parse
+    :param base_url: url under which the fixtures are served
+    :return: list of (url, content) of every page, every url is different so no page is filtered as duplicate
+    """
+    return [(base_url + fixtures[i % len(fixtures)][0] + '?page=' + str(i), fixtures[i % len(fixtures)][1])
+            for i in range(pages)]
+
+
+def run_direct(spider_class, pages, timings):
+    """
+    Give the pages to the parse function of the spider as HtmlResponse objects, without any download
+    :return: number of items returned by the spider
+    """
+    spider = create_timed_spider(spider_class, timings)(
+        start_urls=[url for url, _ in pages], url_to_id=dict((url, i) for i, (url, _) in enumerate(pages)),
+        use_url_as_id=False)
+    items = 0
+    for url, body in pages:
+        response = HtmlResponse(url=url, body=body, encoding='utf-8', request=Request(url))
+        items += len(spider.parse(response))
+    return items
+
+
+def run_server(spider_class, pages, timings, directory):
+    """
+    Crawl the pages from a local HTTP server which serves the fixtures, includes the download and the engine of scrapy
+    :return: number of items returned by the spider
+    """
+    FixtureHandler.directory = directory
+    server = FixtureServer(('127.0.0.1', SERVER_PORT), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        process = CrawlerProcess({'LOG_LEVEL': 'ERROR'})
+        crawler = process.create_crawler(create_timed_spider(spider_class, timings))
+        process.crawl(crawler, start_urls=[url for url, _ in pages],
+                      url_to_id=dict((url, i) for i, (url, _) in enumerate(pages)), use_url_as_id=False)
+        process.start()
+    finally:
+        server.shutdown()
+    return crawler.stats.get_value('item_scraped_count', 0)
+
+
+def peak_memory():
+    """
+    :return: peak resident memory of the process in MB, None if it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+
+def benchmark(name, directory=None, pages=BENCHMARK_PAGES, server=False):
+    """
+    Run a spider over the fixtures and report pages/s, parse time per page and peak memory
+    :param name: name of the spider, one of SPIDERS
+    :param directory: directory of the fixtures, by default FIXTURE_DIRECTORY/<name>
+    :param pages: number of pages to parse
+    :param server: crawl the fixtures from a local HTTP server instead of parsing them directly
+    :return: dictionary with the measurements
+    """
+    spider_class = SPIDERS[name]
+    if directory is None:
+        directory = os.path.join(FIXTURE_DIRECTORY, name)
+    fixtures = read_fixtures(directory)
+    base_url = 'http://127.0.0.1:' + str(SERVER_PORT) + '/'
+    pages = page_urls(fixtures, pages, base_url)
+    timings = []
+    # The spiders print every collected hotel, this is not part of the measurement
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        if server:
+            items = run_server(spider_class, pages, timings, directory)
+        else:
+            items = run_direct(spider_class, pages, timings)
+    finally:
+        elapsed = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+    timings.sort()
+    result = {
+        'spider': name,
+        'mode': 'server' if server else 'direct',
+        'fixtures': len(fixtures),
+        'pages': len(timings),
+        'items': items,
+        'seconds': elapsed,
+        'pages_per_second': len(timings) / elapsed if elapsed > 0 else 0.0,
+        'parse_ms_mean': 1000.0 * sum(timings) / len(timings) if len(timings) > 0 else 0.0,
+        'parse_ms_median': 1000.0 * timings[len(timings) // 2] if len(timings) > 0 else 0.0,
+        'peak_memory_mb': peak_memory(),
+    }
+    print(name + " (" + result['mode'] + "): " + str(result['pages']) + " pages from " + str(result['fixtures']) +
+          " fixtures in " + "%.2f" % elapsed + "s, " + "%.1f" % result['pages_per_second'] + " pages/s, parse time " +
+          "%.3f" % result['parse_ms_mean'] + " ms per page (median " + "%.3f" % result['parse_ms_median'] + " ms), " +
+          str(items) + " items, peak memory " +
+          ("%.1f MB" % result['peak_memory_mb'] if result['peak_memory_mb'] is not None else "unknown"))
+    return result
+
+
+def main():
+    arguments = [argument for argument in sys.argv[1:] if argument != '--server']
+    if len(arguments) == 0 or arguments[0] not in SPIDERS:
+        print(__doc__)
+        sys.exit(1)
+    directory = arguments[1] if len(arguments) > 1 else None
+    pages = int(arguments[2]) if len(arguments) > 2 else BENCHMARK_PAGES
+    benchmark(arguments[0], directory, pages, '--server' in sys.argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,16 +8,23 @@ class BookingSpider(scrapy.Spider):
         'https://www.booking.com/hotel/ch/sporthotelstoos.html',
     ]
 
+    # Number of hotels collected so far
+    collected = 0
+
     custom_settings = {
         'LOG_FILE': 'log/booking.log',
+        # Start delay of the adaptive throttle, see throttle.AdaptiveThrottle
         'DOWNLOAD_DELAY' : 0.40422,
+        'ADAPTIVE_THROTTLE_MIN_DELAY': 0.1,
+        'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 4,
     }
 
 
     def store_result(self, url, dict):
         id = self.url_to_id[url]
-        self.results[id] = dict
-        print(str(len(self.results.keys())) + "/" + str(len(self.url_to_id)) + ": Collected " + dict['bk_name'] + " from Booking.com")
+        self.collected += 1
+        print(str(self.collected) + "/" + str(len(self.url_to_id)) + ": Collected " + dict['bk_name'] + " from Booking.com")
+        return {'id': id, 'attributes': dict}
 
     def parse(self, response):
         url = response.url
@@ -47,4 +54,4 @@ class BookingSpider(scrapy.Spider):
             if len(result) > 0:
                 attributes['bk_'+data_questions[i]] = result[1].replace(",",".").encode('utf-8')
         # Store the result
-        self.store_result(url, attributes)
\ No newline at end of file
+        yield self.store_result(url, attributes)
\ No newline at end of file
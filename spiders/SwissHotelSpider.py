@@ -8,15 +8,22 @@ class SwissHotelSpider(scrapy.Spider):
         'https://hotels.swisshoteldata.ch/?module=hotel&submodule=detail&id=12351',
     ]
 
+    # Number of hotels collected so far
+    collected = 0
+
     custom_settings = {
         'LOG_FILE': 'log/swisshotel.log',
+        # Start delay of the adaptive throttle, see throttle.AdaptiveThrottle
         'DOWNLOAD_DELAY' : 0.2238,
+        'ADAPTIVE_THROTTLE_MIN_DELAY': 0.05,
+        'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 4,
     }
 
     def store_result(self, url, dict):
         id = self.url_to_id[url]
-        self.results[id] = dict
-        print(str(len(self.results.keys())) + "/" + str(len(self.url_to_id)) + ": Collected " + dict['sh_name'] + " from SwissHotel")
+        self.collected += 1
+        print(str(self.collected) + "/" + str(len(self.url_to_id)) + ": Collected " + dict['sh_name'] + " from SwissHotel")
+        return {'id': id, 'attributes': dict}
 
     def clean_list(self, list):
         list = [elem.encode('utf-8') for elem in list]
@@ -110,4 +117,4 @@ class SwissHotelSpider(scrapy.Spider):
             for element in self.clean_list(specialization):
                 attributes['sh_specialization_'+element] = True
 
-        self.store_result(url, attributes)
\ No newline at end of file
+        yield self.store_result(url, attributes)
\ No newline at end of file
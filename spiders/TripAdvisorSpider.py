@@ -1,5 +1,7 @@
 import scrapy
 import re
+import json
+from collections import OrderedDict
 
 class TripAdvisorSpider(scrapy.Spider):
     name = "tripadvisor"
@@ -8,9 +10,15 @@ class TripAdvisorSpider(scrapy.Spider):
         'https://www.tripadvisor.ch/Hotel_Review-g1096125-d1204244-Reviews-Minotel_Alpstubli-Stoos.html',
     ]
 
+    # Number of hotels collected so far
+    collected = 0
+
     custom_settings = {
         'LOG_FILE': 'log/tripadvisor.log',
+        # Start delay of the adaptive throttle, see throttle.AdaptiveThrottle
         'DOWNLOAD_DELAY': 0.631,
+        'ADAPTIVE_THROTTLE_MIN_DELAY': 0.2,
+        'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 2,
     }
 
     allowed_values = ['name', 'pricerange', 'ratingvalue', 'reviewcount', 'streetaddress', 'addresslocality', 'postalcode']
@@ -19,19 +27,60 @@ class TripAdvisorSpider(scrapy.Spider):
         if 'ta_addresslocality' in dict.keys():
             dict['ta_city'] = dict['ta_addresslocality']
             del dict['ta_addresslocality']
+        self.collected += 1
         if self.use_url_as_id:
-            self.results[url] = dict
-            print(str(len(self.results.keys())) + "/" + str(len(self.start_urls)) + ": Collected " + dict[
+            id = url
+            print(str(self.collected) + "/" + str(len(self.start_urls)) + ": Collected " + dict[
                 'ta_name'] + " from TripAdvisor, storing on ID " + str(url))
         else:
             id = self.url_to_id[url]
-            self.results[id] = dict
-            print(str(len(self.results.keys())) + "/" + str(len(self.url_to_id)) + ": Collected " + dict['ta_name'] + " from TripAdvisor, storing on ID " + str(id))
+            print(str(self.collected) + "/" + str(len(self.url_to_id)) + ": Collected " + dict['ta_name'] + " from TripAdvisor, storing on ID " + str(id))
+        return {'id': id, 'attributes': dict}
 
-    def parse(self, response):
-        url = response.url
-        # Lets try to extract the info directly from the script tag
-        script_content = response.xpath('//*[@type="application/ld+json"]/text()').extract()[0]
+    def parse_json_ld(self, script_content):
+        """
+        Decode the JSON-LD of the page and keep the allowed values, the first occurrence of a value in the order of the
+        document wins, so the name of the hotel is not overwritten with the name of the country
+        :param script_content: content of the application/ld+json script tag
+        :return: dictionary of the attributes, None if the content is not valid JSON
+        """
+        try:
+            data = json.loads(script_content, object_pairs_hook=OrderedDict)
+        except ValueError:
+            return None
+        storable_attributes = {}
+        self.collect_json_ld_values(data, storable_attributes)
+        return storable_attributes
+
+    def collect_json_ld_values(self, node, storable_attributes):
+        """
+        Depth first search through the decoded JSON-LD for the allowed values
+        :param node: decoded JSON object, list or value
+        :param storable_attributes: dictionary to which the attributes are added
+        :return: None
+        """
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(value, (dict, list)):
+                    self.collect_json_ld_values(value, storable_attributes)
+                    continue
+                id = key.lower().strip()
+                if id in self.allowed_values and 'ta_' + id not in storable_attributes and value is not None:
+                    if not isinstance(value, basestring):
+                        value = str(value)
+                    # Remove the non-breaking spaces
+                    storable_attributes['ta_' + id] = value.replace(u"\xa0", u"").strip().encode('utf-8')
+        elif isinstance(node, list):
+            for element in node:
+                self.collect_json_ld_values(element, storable_attributes)
+
+    def parse_json_ld_string(self, script_content):
+        """
+        Extract the allowed values from the JSON-LD by splitting the text, for content which is not valid JSON. Values
+        containing a ',' or ':' are lost
+        :param script_content: content of the application/ld+json script tag
+        :return: dictionary of the attributes
+        """
         # Change encoding from unicode to ascii
         script_content = script_content.encode('utf-8')
         # Clean the data
@@ -52,9 +101,18 @@ class TripAdvisorSpider(scrapy.Spider):
                     if 'ta_' + id not in storable_attributes.keys():
                         # Remove the non-breaking space in UTF-8 character
                         storable_attributes['ta_' + id] = value.replace("\xc2\xa0", "")
+        return storable_attributes
+
+    def parse(self, response):
+        url = response.url
+        # Lets try to extract the info directly from the script tag
+        script_content = response.xpath('//*[@type="application/ld+json"]/text()').extract()[0]
+        storable_attributes = self.parse_json_ld(script_content)
+        if storable_attributes is None:
+            storable_attributes = self.parse_json_ld_string(script_content)
 
         # Treat the rare case where letters are in the code (example: CH-3843)
         if 'ta_postalcode' in storable_attributes.keys():
             storable_attributes['ta_postalcode'] = re.sub("[^0-9]", "", storable_attributes['ta_postalcode'])
 
-        self.store_result(url, storable_attributes)
+        yield self.store_result(url, storable_attributes)
@@ -0,0 +1,42 @@
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.extensions.httpcache import RFC2616Policy
+
+
+class RevalidatingPolicy(RFC2616Policy):
+    """
+        HTTP cache policy which revalidates every stale page with a conditional request (If-None-Match and
+        If-Modified-Since). RFC2616Policy downloads pages sent with no-cache again without the validators, which is
+        common for dynamic pages like the ones of the hotel websites.
+    """
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        if RFC2616Policy.is_cached_response_fresh(self, cachedresponse, request):
+            return True
+        self._set_conditional_validators(request, cachedresponse)
+        return False
+
+
+class SkipUnchangedMiddleware(object):
+    """
+        Downloader middleware for recrawls with the HTTP cache (RevalidatingPolicy). Pages which are still fresh or were
+        confirmed unchanged by the server (304 Not Modified) come from the cache, if their item is already in the results
+        file of a previous crawl they are dropped before the spider parses them again. Needs to be placed after the
+        HttpCacheMiddleware (900), e.g. at 890, so it sees the responses the cache returns.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('HTTPCACHE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def process_response(self, request, response, spider):
+        # The urls whose item is stored are given to the spider, a spider without them parses every page
+        stored_urls = getattr(spider, 'stored_urls', None)
+        if 'cached' in response.flags and stored_urls and request.url in stored_urls:
+            self.stats.inc_value('httpcache/skipped_unchanged', spider=spider)
+            raise IgnoreRequest('Unchanged page ' + request.url)
+        return response
@@ -0,0 +1,220 @@
+import gzip
+import io
+import json
+import os
+import struct
+import zlib
+
+
+class JsonLinesPipeline(object):
+    """
+        Item pipeline which writes the items of a spider to a JSON Lines file while the crawl is running, so the results
+        do not have to be kept in memory and survive if the crawl is interrupted. The items of a run are written in
+        batches to a plain part file next to the results file, every batch is synced to the disk. When the spider
+        closes the part file is compressed into a new gzip member of the results file, a part file left by a crash is
+        compressed when the next run starts. A crash therefore never leaves an open gzip member behind.
+    """
+
+    def __init__(self, directory, batch_size):
+        """
+        :param directory: directory of the files, used if the spider has no results_file
+        :param batch_size: number of items written at once
+        """
+        self.directory = directory
+        self.batch_size = batch_size
+        self.batch = []
+        self.filename = None
+        self.file = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('RESULTS_DIRECTORY', 'results'), crawler.settings.getint('RESULTS_BATCH_SIZE', 100))
+
+    def open_spider(self, spider):
+        filename = getattr(spider, 'results_file', None)
+        if filename is None:
+            filename = results_filename(self.directory, spider.name)
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        recover_results(filename)
+        self.filename = filename
+        self.file = open(part_filename(filename), 'ab')
+
+    def process_item(self, item, spider):
+        self.batch.append(json.dumps(dict(item), default=to_json))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return item
+
+    def flush(self):
+        if len(self.batch) > 0:
+            self.file.write(('\n'.join(self.batch) + '\n').encode('utf-8'))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.batch = []
+
+    def close_spider(self, spider):
+        self.flush()
+        self.file.close()
+        compress_part(self.filename)
+
+
+def to_json(value):
+    """
+    Conversion of the values json does not know, e.g. numpy numbers used as ids
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def results_filename(directory, name):
+    """
+    :param directory: directory of the results
+    :param name: name of the spider
+    :return: path of the JSON Lines file of the spider
+    """
+    return os.path.join(directory, name + '.jsonl.gz')
+
+
+def part_filename(filename):
+    """
+    :param filename: path of the results file
+    :return: path of the uncompressed part file of the running crawl
+    """
+    return filename + '.part'
+
+
+def remove_results(filename):
+    """
+    Remove the results file and its part file
+    :param filename: path of the results file
+    :return: None
+    """
+    for path in [filename, part_filename(filename)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def parse_line(line):
+    """
+    :param line: line of a JSON Lines file as bytes
+    :return: the item, None if the line is empty or not complete (last line of an interrupted crawl)
+    """
+    line = line.strip()
+    if len(line) == 0:
+        return None
+    try:
+        item = json.loads(line.decode('utf-8'))
+    except ValueError:
+        return None
+    # A cut line can still be valid JSON
+    if not isinstance(item, dict) or 'id' not in item or 'attributes' not in item:
+        return None
+    return item
+
+
+def read_part(filename):
+    """
+    :param filename: path of the results file
+    :return: list of the complete items in its part file
+    """
+    items = []
+    if os.path.exists(part_filename(filename)):
+        with open(part_filename(filename), 'rb') as file:
+            for line in file:
+                item = parse_line(line)
+                if item is not None:
+                    items.append(item)
+    return items
+
+
+def compress_part(filename):
+    """
+    Append the complete items of the part file as a new gzip member to the results file and remove the part file
+    :param filename: path of the results file
+    :return: None
+    """
+    items = read_part(filename)
+    if len(items) > 0:
+        with gzip.open(filename, 'ab') as file:
+            file.write(('\n'.join(json.dumps(item, default=to_json) for item in items) + '\n').encode('utf-8'))
+    if os.path.exists(part_filename(filename)):
+        os.remove(part_filename(filename))
+
+
+def read_compressed(filename):
+    """
+    Read the gzip file member by member, only the items of members whose length and checksum are correct are kept. A
+    truncated member does not only lose its last line, the data decompressed before the cut can be corrupt.
+    :param filename: path of the results file
+    :return: tuple of the list of the items of the complete members and if the whole file could be read, a file
+    interrupted while a member was written ends in a truncated or corrupt member
+    """
+    items = []
+    if not os.path.exists(filename):
+        return items, True
+    with open(filename, 'rb') as file:
+        data = file.read()
+    while len(data) > 0:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            content = decompressor.decompress(data)
+            rest = decompressor.unused_data
+            if len(rest) == 0:
+                # The end of the last member is not known, gzip checks if it is complete
+                content = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        except (EOFError, IOError, struct.error, zlib.error):
+            return items, False
+        for line in content.splitlines():
+            item = parse_line(line)
+            if item is not None:
+                items.append(item)
+        data = rest
+    return items, True
+
+
+def recover_results(filename):
+    """
+    Repair the results of an interrupted crawl before more items are added: a results file which ends in a truncated
+    member is written again with its complete items, nothing can be read after such a member, and a part file left
+    behind is compressed
+    :param filename: path of the results file
+    :return: None
+    """
+    items, complete = read_compressed(filename)
+    if not complete:
+        print("The results in " + filename + " end abruptly, keeping the " + str(len(items)) + " complete items")
+        recovered = filename + '.recovered'
+        with gzip.open(recovered, 'wb') as file:
+            file.write(''.join(json.dumps(item, default=to_json) + '\n' for item in items).encode('utf-8'))
+        os.remove(filename)
+        os.rename(recovered, filename)
+    compress_part(filename)
+
+
+def read_results(filename):
+    """
+    Read the items written by JsonLinesPipeline back into the dictionary the spiders used to fill, including the
+    items in the part file of a crawl which did not finish
+    :param filename: path of the JSON Lines file
+    :return: dictionary from the id of every item to its attributes, later items overwrite earlier ones
+    """
+    items, complete = read_compressed(filename)
+    if not complete:
+        print("The results in " + filename + " end abruptly, using the " + str(len(items)) + " complete items")
+    results = {}
+    for item in items + read_part(filename):
+        results[item['id']] = item['attributes']
+    return results
+
+
+def completed_ids(filename):
+    """
+    Ledger of a crawl: an item is only written once its page was parsed, so the ids in the results file are the ones
+    which do not have to be crawled again when the crawl is resumed
+    :param filename: path of the JSON Lines file
+    :return: set of the ids of all items in the file
+    """
+    return set(read_results(filename).keys())
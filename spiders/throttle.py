@@ -0,0 +1,144 @@
+import time
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+class AdaptiveThrottle(object):
+    """
+        Extension which adapts the delay and the concurrency of every domain (download slot) to its responses, instead
+        of the fixed DOWNLOAD_DELAY of the spiders. A domain starts with the DOWNLOAD_DELAY and one request at a time.
+        While the responses are healthy, fast enough and no 429 or 5xx, the delay is lowered step by step down to the
+        minimal delay and then one more concurrent request is allowed after every round of healthy responses
+        (additive increase). A 429 or 5xx response halves the concurrency and doubles the delay, at least to the
+        latency of the response or as long as its Retry-After header asks for (multiplicative decrease), a slow response
+        lowers the concurrency by one.
+        The request rate achieved for every domain is reported when the spider closes.
+
+        All settings can be given per spider in its custom_settings:
+        ADAPTIVE_THROTTLE_ENABLED, ADAPTIVE_THROTTLE_START_DELAY (default DOWNLOAD_DELAY), ADAPTIVE_THROTTLE_MIN_DELAY,
+        ADAPTIVE_THROTTLE_MAX_DELAY, ADAPTIVE_THROTTLE_START_CONCURRENCY, ADAPTIVE_THROTTLE_MAX_CONCURRENCY,
+        ADAPTIVE_THROTTLE_TARGET_LATENCY, ADAPTIVE_THROTTLE_DELAY_DECREASE and ADAPTIVE_THROTTLE_BACKOFF_CODES
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED', True):
+            raise NotConfigured
+        self.crawler = crawler
+        self.start_delay = settings.getfloat('ADAPTIVE_THROTTLE_START_DELAY', settings.getfloat('DOWNLOAD_DELAY'))
+        self.min_delay = settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.0)
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 60.0)
+        self.start_concurrency = settings.getint('ADAPTIVE_THROTTLE_START_CONCURRENCY', 1)
+        self.max_concurrency = settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY', 8)
+        # Responses slower than this (in seconds) count as a sign of an overloaded server
+        self.target_latency = settings.getfloat('ADAPTIVE_THROTTLE_TARGET_LATENCY', 2.0)
+        # Factor by which the delay is lowered after a healthy response
+        self.delay_decrease = settings.getfloat('ADAPTIVE_THROTTLE_DELAY_DECREASE', 0.9)
+        self.backoff_codes = set(int(code) for code in settings.getlist('ADAPTIVE_THROTTLE_BACKOFF_CODES',
+                                                                        [429, 500, 502, 503, 504]))
+        # Counters and the current state of every domain, by slot key
+        self.domains = {}
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        # Sent once the download slot of a request exists and before its first request is sent, not available
+        # before Scrapy 2.0, the slots are then set up with the first response
+        if hasattr(signals, 'request_reached_downloader'):
+            crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        # New download slots take their delay from the spider
+        spider.download_delay = self.start_delay
+
+    def add_domain(self, key, slot, first):
+        """
+        Start a domain with the start concurrency
+        :param key: key of the download slot
+        :param slot: the download slot
+        :param first: time at which the first request of the domain was sent
+        :return: dictionary with the counters and the state of the domain
+        """
+        slot.concurrency = self.start_concurrency
+        domain = {'first': first, 'responses': 0, 'backoffs': 0, 'healthy': 0, 'backed_off': 0.0,
+                  'delay': slot.delay, 'concurrency': slot.concurrency, 'slot': slot}
+        self.domains[key] = domain
+        return domain
+
+    def request_reached_downloader(self, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        domain = self.domains.get(key)
+        if domain is None:
+            self.add_domain(key, slot, time.time())
+        elif domain['slot'] is not slot:
+            # The slot was removed while the domain was idle, the new one continues with the state of the old one
+            slot.delay, slot.concurrency = domain['delay'], domain['concurrency']
+            domain['slot'] = slot
+
+    def retry_after(self, response):
+        """
+        :param response: response which asked to slow down
+        :return: seconds to wait according to the Retry-After header, 0 if it has none or it is not a number
+        """
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value) if value is not None else 0.0
+        except ValueError:
+            return 0.0
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        latency = request.meta.get('download_latency')
+        if slot is None or latency is None:
+            return
+        now = time.time()
+        domain = self.domains.get(key)
+        if domain is None:
+            domain = self.add_domain(key, slot, now - latency)
+        domain['responses'] += 1
+        domain['last'] = now
+        if response.status in self.backoff_codes:
+            domain['healthy'] = 0
+            # Requests sent before the last backoff belong to the same overload, back off only once for all of them
+            if now - latency >= domain['backed_off']:
+                domain['backoffs'] += 1
+                domain['backed_off'] = now
+                slot.concurrency = max(1, slot.concurrency // 2)
+                slot.delay = min(self.max_delay, max(slot.delay * 2, latency, self.retry_after(response)))
+        elif latency > self.target_latency:
+            domain['healthy'] = 0
+            slot.concurrency = max(1, slot.concurrency - 1)
+        else:
+            domain['healthy'] += 1
+            if slot.delay > self.min_delay:
+                delay = slot.delay * self.delay_decrease
+                # A delay far below the latency hardly limits the rate any more
+                slot.delay = delay if delay > max(self.min_delay, latency / 10) else self.min_delay
+            elif domain['healthy'] >= slot.concurrency:
+                # A full round of healthy responses at the current concurrency
+                slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+                domain['healthy'] = 0
+        domain['delay'] = slot.delay
+        domain['concurrency'] = slot.concurrency
+
+    def spider_closed(self, spider, reason):
+        stats = self.crawler.stats
+        for key in sorted(self.domains.keys()):
+            domain = self.domains[key]
+            if domain['responses'] == 0:
+                continue
+            elapsed = domain['last'] - domain['first']
+            rate = domain['responses'] / elapsed if elapsed > 0 else 0.0
+            print("Adaptive throttle for " + str(key) + ": " + str(domain['responses']) + " responses in " +
+                  "%.1f" % elapsed + "s, " + "%.2f" % rate + " requests/s, " + str(domain['backoffs']) +
+                  " backoffs, final delay " + "%.3f" % domain['delay'] + "s and concurrency " +
+                  str(domain['concurrency']))
+            stats.set_value('adaptive_throttle/' + str(key) + '/rate', round(rate, 3), spider=spider)
+            stats.set_value('adaptive_throttle/' + str(key) + '/backoffs', domain['backoffs'], spider=spider)